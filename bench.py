@@ -0,0 +1,415 @@
+#!/usr/bin/python
+
+# Microbenchmarks for the hot paths of the system. Each subcommand runs
+# one benchmark and prints a small table, e.g.
+#   python bench.py codec
+
+import os
+import gc
+import shutil
+import tempfile
+import threading
+import argparse
+import json
+import random
+import time
+import codec
+import common
+import common2
+import kvstore
+import wal
+import bloom
+import viewleader
+
+# Seconds per call of fn, the best of several rounds of n calls
+def timed(fn, n, rounds=3):
+    best = None
+    for r in range(rounds):
+        start = time.time()
+        for i in xrange(n):
+            fn()
+        elapsed = (time.time() - start) / n
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def random_key(rng):
+    return "user:%08d" % rng.randint(0, 10 ** 8)
+
+def random_val(rng):
+    return "".join(chr(rng.randint(97, 122)) for i in range(rng.randint(16, 128)))
+
+##############
+# codec: JSON against the binary codec on the messages that dominate the
+# traffic. Messages are passed through JSON first, as they would be when
+# read off a JSON connection, so their strings are unicode. Binary comes
+# out about as large as JSON; what it saves is encoding and decoding time.
+
+def codec_shapes(rng):
+    store = dict((random_key(rng), {"val": random_val(rng)}) for i in range(500))
+    serverdata = dict((rng.randint(0, 2 ** 32), {"host": "10.0.%s.%s" % (i // 250, i % 250),
+        "port": 38000 + i % 10}) for i in range(50))
+    shapes = [
+        ("setr", {"cmd": "setr", "key": random_key(rng), "val": random_val(rng),
+            "server": "localhost", "viewleader": "localhost"}),
+        ("vote", {"vote": "yes", "epoch": 1234}),
+        ("share reply (500 keys)", {"store": store}),
+        ("rebalance (50 servers)", {"cmd": "rebalance", "epoch": 1234, "group_size": 50,
+            "view": serverdata.keys(), "serverdata": serverdata}),
+        ("mget reply (100 keys)", {"results": dict((random_key(rng),
+            {"status": "ok", "value": random_val(rng)}) for i in range(100))}),
+    ]
+    return [(name, json.loads(json.dumps(msg))) for (name, msg) in shapes]
+
+def bench_codec(args):
+    rng = random.Random(args.seed)
+    print "%-24s %8s %8s | %9s %9s | %9s %9s" % ("message", "json B", "binary B",
+        "json enc", "bin enc", "json dec", "bin dec")
+    for (name, msg) in codec_shapes(rng):
+        row = [name]
+        encoded = {}
+        for codec_id in (codec.JSON, codec.BINARY):
+            encoded[codec_id] = codec.encode(codec_id, msg)
+            assert codec.decode(codec_id, encoded[codec_id]) == msg
+            row.append(len(encoded[codec_id]))
+        n = max(10, args.n // max(1, len(encoded[codec.JSON]) // 100))
+        for codec_id in (codec.JSON, codec.BINARY):
+            row.append(timed(lambda: codec.encode(codec_id, msg), n) * 1e6)
+        for codec_id in (codec.JSON, codec.BINARY):
+            row.append(timed(lambda: codec.decode(codec_id, encoded[codec_id]), n) * 1e6)
+        print "%-24s %8d %8d | %7.1fus %7.1fus | %7.1fus %7.1fus" % tuple(row)
+
+##############
+# ring: building a Ring over a large view and looking keys up in it,
+# against the sort-per-call allocator it replaced, and the spread of
+# keys over servers with and without virtual nodes.
+
+# The allocator as it was before common.Ring, for comparison
+def legacy_bucket_allocator(k, sids):
+    if len(sids) < 3:
+        return sids
+    h = common.hash_key(k)
+    sids.sort()
+    if h > sids[-1]:
+        return sids[0:3]
+    elif h > sids[-2]:
+        return [sids[-1], sids[0], sids[1]]
+    elif h > sids[-3]:
+        return [sids[-2], sids[-1], sids[0]]
+    else:
+        for i in range(len(sids)):
+            if h < sids[i]:
+                return [sids[i], sids[i+1], sids[i+2]]
+
+def bench_ring(args):
+    rng = random.Random(args.seed)
+    sids = rng.sample(xrange(common.HASH_MAX), args.servers)
+    hashes = [rng.randrange(common.HASH_MAX) for i in xrange(args.lookups)]
+    keys = [random_key(rng) for i in xrange(min(args.lookups, 10000))]
+    print "%d servers, replication %d" % (args.servers, common2.REPLICATION)
+
+    for vnodes in sorted(set([1, args.vnodes])):
+        start = time.time()
+        ring = common.Ring(sids, vnodes)
+        built = time.time() - start
+
+        start = time.time()
+        replicas_for = ring.replicas_for
+        for h in hashes:
+            replicas_for(h)
+        looked_up = time.time() - start
+
+        # the fraction of the ring each server stores, relative to the mean
+        shares = [sum(hi - lo for (lo, hi) in ring.arcs(sid)) for sid in sids]
+        mean = float(sum(shares)) / len(shares)
+        print "vnodes %3d: build %7.1fms, %d lookups %6.2fs (%.2fus each), load max/mean %.2f min/mean %.2f" % (
+            vnodes, built * 1e3, len(hashes), looked_up, looked_up / len(hashes) * 1e6,
+            max(shares) / mean, min(shares) / mean)
+
+    ring = common.Ring(sids)
+    new = timed(lambda: [ring.allocate(k) for k in keys], 1, 1) / len(keys)
+    # the legacy allocator sorts its argument in place, so after the first
+    # call it only re-sorts an already sorted list
+    legacy_sids = list(sids)
+    old = timed(lambda: [legacy_bucket_allocator(k, legacy_sids) for k in keys], 1, 1) / len(keys)
+    print "allocate by key (hash included): ring %.2fus, legacy sort-per-call %.2fus" % (
+        new * 1e6, old * 1e6)
+
+##############
+# store: what a share request costs a server, picking out the keys on the
+# requestor's arcs from the store's position index, against scanning the
+# whole store and rehashing every key as share used to.
+
+def bench_store(args):
+    rng = random.Random(args.seed)
+    entries = dict((random_key(rng), {"val": "x"}) for i in xrange(args.keys))
+    start = time.time()
+    store = kvstore.Store(entries)
+    store.sort()
+    built = time.time() - start
+    sids = rng.sample(xrange(common.HASH_MAX), args.servers)
+    ring = common.Ring(sids)
+    print "%d keys, %d servers: store built and indexed in %.1fms" % (
+        len(store), len(sids), built * 1e3)
+
+    sid = sids[0]
+    is_relevant = common.coverageFn(sid, sids)
+    scan = lambda: [k for k in store.keys() if is_relevant(common.hash_key(k))]
+    indexed = lambda: store.in_arcs(ring.arcs(sid))
+    assert sorted(scan()) == sorted(indexed())
+    old = timed(scan, 1)
+    new = timed(indexed, 1)
+    print "share of %d keys: index %.2fms, scan and rehash %.2fms" % (
+        len(indexed()), new * 1e3, old * 1e3)
+
+##############
+# wal: durable writes from many threads at once, each waiting for its own
+# record to reach the disk, with group commit (wal.Log) against an fsync
+# per write; then restart time from a snapshot against replaying the same
+# store from the log.
+
+def bench_wal(args):
+    rng = random.Random(args.seed)
+    data_dir = tempfile.mkdtemp(prefix="bench-wal-", dir=args.dir)
+    try:
+        records = [("set", random_key(rng), {"val": random_val(rng)}) for i in xrange(args.writes)]
+        print "%d writes from %d threads" % (args.writes, args.threads)
+        for group in (True, False):
+            log = wal.Log(data_dir, 1 if group else 2)
+            lock = threading.Lock()
+            def write(mine):
+                for record in mine:
+                    if group:
+                        log.append([record])
+                        log.sync()
+                    else:
+                        with lock:
+                            log.file.write(wal.encode_record(record))
+                            log.file.flush()
+                            os.fsync(log.file.fileno())
+            threads = [threading.Thread(target=write, args=(records[i::args.threads],))
+                for i in range(args.threads)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+            log.close()
+            print "%-18s %8.0f writes/s" % ("group commit" if group else "fsync per write",
+                args.writes / elapsed)
+
+        entries = dict((random_key(rng), {"val": random_val(rng)}) for i in xrange(args.keys))
+        log = wal.Log(data_dir, 3)
+        log.append([("set", key, entries[key]) for key in entries])
+        log.sync()
+        log.close()
+        wal.write_snapshot(data_dir, 3, kvstore.Store(entries).dump())
+
+        # as in server.recover
+        gc.disable()
+        start = time.time()
+        (segment, dump) = wal.read_snapshot(data_dir)
+        store = kvstore.Store()
+        store.load(*dump)
+        from_snapshot = time.time() - start
+
+        start = time.time()
+        store = kvstore.Store()
+        for (op, key, entry) in wal.read_records(wal.segment_path(data_dir, 3)):
+            store[key] = entry
+        store.sort()
+        from_log = time.time() - start
+        gc.enable()
+        print "restart with %d keys: snapshot %.2fs, log replay %.2fs" % (
+            len(store), from_snapshot, from_log)
+    finally:
+        shutil.rmtree(data_dir)
+
+##############
+# leases: the viewleader's heartbeat handling with thousands of servers
+# heartbeating, on a simulated clock, against the list-scanning lease
+# table it replaced. A few servers stop heartbeating and are replaced by
+# new ones each interval, so expiry is exercised as well.
+
+# The lease table as it was before the dict and heap, for comparison
+def legacy_heartbeat(leases, expired, lockid, requestor, now):
+    leases[:] = [lease for lease in leases if now - lease["timestamp"] <= common2.LOCK_LEASE
+        or expired.append(lease["requestor"])]
+    if requestor in expired:
+        return
+    for lease in leases:
+        if lease["lockid"] == lockid:
+            lease["timestamp"] = now
+            break
+    else:
+        leases.append({"lockid": lockid, "requestor": requestor, "timestamp": now})
+
+class SimulatedClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+def bench_leases(args):
+    interval = 10.0
+    real_time = viewleader.time
+    real_schedule = viewleader.schedule_rebalance
+    clock = SimulatedClock()
+    rebalances = [0]
+    viewleader.time = clock
+    viewleader.schedule_rebalance = lambda reason: rebalances.__setitem__(0, rebalances[0] + 1)
+    try:
+        print "%d heartbeats per size, one per server every %.0fs, lease %ss" % (
+            args.heartbeats, interval, common2.LOCK_LEASE)
+        for n in args.servers:
+            rng = random.Random(args.seed)
+            row = []
+            for legacy in (False, True):
+                if legacy and n > args.legacy_max:
+                    row.append(None)
+                    continue
+                clock.now = 0.0
+                rebalances[0] = 0
+                viewleader.leases.clear()
+                del viewleader.lease_heap[:]
+                viewleader.expired.clear()
+                leases = []
+                expired = []
+                servers = [("10.%d.%d.%d" % (i >> 16, (i >> 8) & 255, i & 255), 38000, str(i))
+                    for i in range(n)]
+                joined = n
+                start = time.time()
+                for beat in xrange(args.heartbeats):
+                    clock.now += interval / n
+                    slot = beat % n
+                    if rng.random() < args.churn:
+                        # this server dies, and a new one takes its place
+                        servers[slot] = ("10.255.%d.%d" % (joined >> 8 & 255, joined & 255),
+                            38001 + joined // 65536, str(joined))
+                        joined += 1
+                    (addr, port, requestor) = servers[slot]
+                    if legacy:
+                        legacy_heartbeat(leases, expired, "%s:%s" % (addr, port), requestor, clock.now)
+                    else:
+                        viewleader.server_lease({"port": port, "requestor": requestor}, addr)
+                row.append((time.time() - start) / args.heartbeats)
+            print "%6d servers: indexed %7.2fus per heartbeat, list scan %s" % (n, row[0] * 1e6,
+                "%.2fus" % (row[1] * 1e6) if row[1] is not None else "(skipped)")
+    finally:
+        viewleader.time = real_time
+        viewleader.schedule_rebalance = real_schedule
+
+##############
+# memory: resident bytes per key of a server's store at a million keys,
+# for the dict-of-dicts store with a tuple per key in its index, which the
+# compact kvstore.Store replaced, and for the compact store with and
+# without the Bloom filter a server keeps. Each is built in a child
+# process of its own, so that one doesn't reuse memory freed by another.
+
+class LegacyStore(object):
+    def __init__(self):
+        self.entries = {}
+        self.positions = {}
+        self.index = []
+
+    def __setitem__(self, key, entry):
+        if key not in self.positions:
+            self.positions[key] = common.hash_key(key)
+            self.index.append((self.positions[key], key))
+        self.entries[key] = entry
+
+    def sort(self):
+        self.index.sort()
+
+def resident():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+# Bytes per key that make_store() takes with n keys, measured in a child
+def store_footprint(make_store, n, seed):
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        rng = random.Random(seed)
+        gc.disable()
+        before = resident()
+        store = make_store()
+        for i in xrange(n):
+            store["user:%08d" % i] = {"val": "%016x" % rng.getrandbits(64), "version": common.new_version()}
+            # as a server's arc queries would, now and then
+            if i % 10000 == 0:
+                store.sort()
+        store.sort()
+        os.write(w, "%d" % (resident() - before))
+        os._exit(0)
+    os.close(w)
+    used = int(os.read(r, 64))
+    os.close(r)
+    os.waitpid(pid, 0)
+    return float(used) / n
+
+def bench_memory(args):
+    print "%d keys, 13-byte keys and 16-byte values" % args.keys
+    stores = [
+        ("dict of dicts", LegacyStore),
+        ("compact", kvstore.Store),
+        ("compact + filter", lambda: kvstore.Store(filter=bloom.CountingBloom())),
+    ]
+    for (name, make_store) in stores:
+        print "%-18s %6.0f bytes per key" % (name, store_footprint(make_store, args.keys, args.seed))
+    store = kvstore.Store()
+    for i in xrange(min(args.keys, 100000)):
+        store["user:%08d" % i] = {"val": "%016x" % i, "version": common.new_version()}
+    print "accounted by the store: %.0f bytes per key" % (float(store.size) / len(store))
+
+##############
+# Main program
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=360)
+    subparsers = parser.add_subparsers(dest='bench')
+
+    parser_codec = subparsers.add_parser('codec')
+    parser_codec.add_argument('-n', type=int, default=20000)
+    parser_codec.set_defaults(fn=bench_codec)
+
+    parser_ring = subparsers.add_parser('ring')
+    parser_ring.add_argument('--servers', type=int, default=1000)
+    parser_ring.add_argument('--lookups', type=int, default=1000000)
+    parser_ring.add_argument('--vnodes', type=int, default=common2.VNODES)
+    parser_ring.set_defaults(fn=bench_ring)
+
+    parser_store = subparsers.add_parser('store')
+    parser_store.add_argument('--keys', type=int, default=200000)
+    parser_store.add_argument('--servers', type=int, default=16)
+    parser_store.set_defaults(fn=bench_store)
+
+    parser_wal = subparsers.add_parser('wal')
+    parser_wal.add_argument('--writes', type=int, default=2000)
+    parser_wal.add_argument('--threads', type=int, default=common2.WORKERS)
+    parser_wal.add_argument('--keys', type=int, default=500000)
+    parser_wal.add_argument('--dir', help="where to put the log, by default the temp directory")
+    parser_wal.set_defaults(fn=bench_wal)
+
+    parser_leases = subparsers.add_parser('leases')
+    parser_leases.add_argument('--servers', type=int, nargs='+', default=[100, 1000, 10000])
+    parser_leases.add_argument('--heartbeats', type=int, default=50000)
+    parser_leases.add_argument('--churn', type=float, default=0.001,
+        help="chance that a heartbeating server is replaced by a new one")
+    parser_leases.add_argument('--legacy-max', type=int, default=5000,
+        help="skip the list-scan comparison above this many servers")
+    parser_leases.set_defaults(fn=bench_leases)
+
+    parser_memory = subparsers.add_parser('memory')
+    parser_memory.add_argument('--keys', type=int, default=1000000)
+    parser_memory.set_defaults(fn=bench_memory)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
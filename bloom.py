@@ -0,0 +1,93 @@
+import base64
+import struct
+import hashlib
+
+# Bloom filters over the keys of a server's store, so that a client can
+# tell which replicas certainly don't have a key without asking them.
+#
+# A server keeps a CountingBloom, with a counter for each bit, so that
+# keys can be taken out again as well as put in (a server drops keys when
+# it rebalances). The bits the counters imply are kept up to date beside
+# them, and are what the server publishes: snapshot() gives them base64
+# encoded, so that they travel in either codec and keep in the client's
+# JSON view cache, and a Bloom built from a snapshot tests keys against
+# them.
+
+# bits per key a filter is sized for, and bits set per key: about 1% of
+# the keys a filter doesn't hold test positive
+BITS_PER_KEY = 10
+HASHES = 7
+MIN_CAPACITY = 1024
+
+HASH = struct.Struct("!QQ")
+
+# The bits of a filter of size bits that key sets, by double hashing
+def positions(key, size, hashes):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    (h1, h2) = HASH.unpack(hashlib.md5(key).digest())
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+class Bloom(object):
+    def __init__(self, snapshot):
+        self.bits = bytearray(base64.b64decode(snapshot["bits"]))
+        self.size = snapshot["size"]
+        self.hashes = snapshot["hashes"]
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in positions(key, self.size, self.hashes):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        bits = self.bits
+        for p in positions(key, self.size, self.hashes):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def snapshot(self):
+        return {"bits": base64.b64encode(str(self.bits)), "size": self.size,
+            "hashes": self.hashes}
+
+# A filter that keys can be removed from. Counters stop at 255; a counter
+# that got there no longer knows how many keys share its bit, so it is
+# never decremented again. version goes up with every change, so that a
+# server knows when it has a new snapshot to publish.
+class CountingBloom(Bloom):
+    def __init__(self, capacity=MIN_CAPACITY):
+        self.capacity = max(capacity, MIN_CAPACITY)
+        self.size = self.capacity * BITS_PER_KEY
+        self.hashes = HASHES
+        self.counts = bytearray(self.size)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.version = getattr(self, "version", -1) + 1
+
+    def add(self, key):
+        counts = self.counts
+        bits = self.bits
+        for p in positions(key, self.size, self.hashes):
+            count = counts[p]
+            if count == 0:
+                bits[p >> 3] |= 1 << (p & 7)
+            if count < 255:
+                counts[p] = count + 1
+        self.version += 1
+
+    def remove(self, key):
+        counts = self.counts
+        bits = self.bits
+        for p in positions(key, self.size, self.hashes):
+            count = counts[p]
+            if count == 0 or count == 255:
+                continue
+            counts[p] = count - 1
+            if count == 1:
+                bits[p >> 3] &= ~(1 << (p & 7)) & 0xff
+        self.version += 1
+
+    # Starts over, sized for capacity keys, holding keys
+    def rebuild(self, keys, capacity):
+        self.__init__(capacity)
+        for key in keys:
+            self.add(key)
@@ -1,40 +1,38 @@
 #!/usr/bin/python
 
 
+import os
+import sys
 import argparse
 import common
 import common2
-import random
-import time
-import json
-
-def send_cancel(k,v,aloc, serverdata):
-    responses=[]
-    i=0
-    for sid in aloc:
-        host=serverdata[sid]["host"]
-        port=serverdata[sid]["port"]
-        responses.insert( i,
-        common.send_receive(host,port, 
-            {"key":k,"value": v, "cmd":"cancel"}))
-
-def send_commit(k,v,aloc,serverdata):
-    responses=[]
-    i=0
-    for sid in aloc:
-        host=serverdata[sid]["host"]
-        port=serverdata[sid]["port"]
-        responses.insert( i,
-        common.send_receive(host,port, 
-            {"key":k,"value": v, "cmd":"commit"}))
-    print "Result:",responses
-
+import dhtclient
+
+# The command line client: runs one operation with a dhtclient.Client
+# and prints its result. The view and the measured latencies are kept
+# in a file shared by every run (--view-cache; an empty name turns the
+# cache off), and the ports found in another (--port-cache), so that a
+# run starts where the last one left off.
+
+# Turns a "k1 v1 k2 v2 ..." argument list into a dict
+def pairs_to_items(pairs):
+    if len(pairs)%2:
+        raise SystemExit("Expected key/value pairs, got an odd number of arguments")
+    return dict(zip(pairs[0::2], pairs[1::2]))
+
+def print_view(view, change):
+    if change is None:
+        print view
+    else:
+        print change
 
 # Client entry point
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--server', default='localhost')
     parser.add_argument('--viewleader', default='localhost')
+    parser.add_argument('--view-cache', default=os.path.expanduser(common2.VIEW_CACHE))
+    parser.add_argument('--port-cache', default=os.path.expanduser(common2.PORT_CACHE))
 
     subparsers = parser.add_subparsers(dest='cmd')
 
@@ -50,10 +48,19 @@ def main():
 
     parser_query = subparsers.add_parser('query_all_keys')
     parser_server_query = subparsers.add_parser('query_servers')
+    parser_rebalance_stats = subparsers.add_parser('rebalance_stats')
+    parser_watch = subparsers.add_parser('watch',
+        help="subscribe to the view, and print every change to it")
+    parser_store_stats = subparsers.add_parser('store_stats')
 
     parser_lock_get = subparsers.add_parser('lock_get')
     parser_lock_get.add_argument('lockid', type=str)    
     parser_lock_get.add_argument('requestor', type=str)    
+    parser_lock_get.add_argument('--wait', type=float, default=common2.LOCK_WAIT,
+        help="seconds the viewleader holds each request until the lock is ours; 0 to poll")
+    parser_lock_get.add_argument('--lease', type=float,
+        help="release the lock, or our place in its queue, if we don't renew "
+            "it (lock_get again) within this many seconds")
 
     parser_lock_get = subparsers.add_parser('lock_release')
     parser_lock_get.add_argument('lockid', type=str)    
@@ -62,83 +69,87 @@ def main():
     parser_setr = subparsers.add_parser('setr')
     parser_setr.add_argument('key', type=str)
     parser_setr.add_argument('val', type=str)
+    parser_setr.add_argument('--w', type=int, default=common2.WRITE_QUORUM,
+        help="replicas that must commit the set")
+    parser_setr.add_argument('--coordinated', action='store_true',
+        help="have --server run the commit, grouped with other clients' sets")
 
     parser_getr = subparsers.add_parser('getr')
     parser_getr.add_argument('key', type=str)
+    parser_getr.add_argument('--r', type=int, default=common2.READ_QUORUM,
+        help="replicas to read, the newest value winning")
+    parser_getr.add_argument('--read-mode', default=common2.READ_MODE,
+        choices=["hedge", "all", "sequential"])
+    parser_getr.add_argument('--bloom', action='store_true', default=common2.BLOOM_READS,
+        help="skip the replicas whose key filters say they don't have the key")
+
+    parser_mset = subparsers.add_parser('mset')
+    parser_mset.add_argument('pairs', nargs='+')
+
+    parser_mget = subparsers.add_parser('mget')
+    parser_mget.add_argument('keys', nargs='+')
+
+    parser_scan = subparsers.add_parser('scan')
+    parser_scan.add_argument('--prefix')
+    parser_scan.add_argument('--start', help="first key of the range")
+    parser_scan.add_argument('--end', help="key the range stops before")
+    parser_scan.add_argument('--order', default="ring", choices=["ring", "key"])
+    parser_scan.add_argument('--values', action='store_true')
+    parser_scan.add_argument('--limit', type=int, help="keys per page")
+
+    parser_msetr = subparsers.add_parser('msetr')
+    parser_msetr.add_argument('pairs', nargs='+')
+    parser_msetr.add_argument('--w', type=int, default=common2.WRITE_QUORUM)
 
     args = parser.parse_args()
 
-    if args.cmd in ['query_servers', 'lock_get', 'lock_release']:
-        while True:
-            response = common.send_receive_range(args.viewleader, common2.VIEWLEADER_LOW, common2.VIEWLEADER_HIGH, vars(args))
-            if response.get("status") == "retry":
-                print "Waiting on lock %s..." % args.lockid
-                time.sleep(5)
-                continue
-            else:
-                break
-        print response
-    elif args.cmd in ['setr', 'getr']:
-        query={'viewleader' : args.viewleader, 'cmd' : 'query_servers', 'server' : args.server}
-        view=common.send_receive_range(args.viewleader, common2.VIEWLEADER_LOW, common2.VIEWLEADER_HIGH, query)
-        if "error" in view:
-            print "Viewleader failure:", view
-            return()
+    client = dhtclient.Client(args.server, args.viewleader, args.view_cache, args.port_cache)
+    if args.cmd=="lock_get":
+        waiting=lambda response : sys.stdout.write("Waiting on lock %s...\n" % args.lockid)
+        print client.lock_get(args.lockid, args.requestor, args.wait, args.lease, waiting).result()
+    elif args.cmd=="lock_release":
+        print client.lock_release(args.lockid, args.requestor).result()
+    elif args.cmd in ["query_servers", "rebalance_stats"]:
+        print client.call_viewleader({"cmd": args.cmd}).result()
+    elif args.cmd=="watch":
+        common.follow_view(args.viewleader, print_view)
+    elif args.cmd=="setr" and args.coordinated:
+        request={"cmd": "csetr", "key": args.key, "val": args.val}
+        print client.call_server(request).result()
+    elif args.cmd=="setr":
+        result=client.setr(args.key, args.val, args.w).result()
+        if "error" in result:
+            print "Set failed: %s" % result["error"]
         else:
-            servers=view['result']
-        if servers==[]:
-            print "No servers available"
+            print "Result:", result["commits"]
+    elif args.cmd=="getr":
+        result=client.getr(args.key, args.r, args.read_mode, args.bloom).result()
+        if result.get("status")=="not_found":
+            print "No such key found in our system"
         else:
-            server_ids=[]
-            serverdata={}
-            for server in servers:
-                (h,p)=common.formatHP(server["location"])
-                server["host"]=h
-                server["port"]=p
-                del server["location"]
-                n=int(server["name"])
-                server_ids.append(n)
-                serverdata[n]=server
-            h=common.hash_key(args.key)
-            aloc=common.bucket_allocator(args.key, server_ids)
-            #list of destination server ids
-            if args.cmd=="getr":
-                responses=[]
-                i=0
-                for sid in aloc:
-                    responses.insert( i,
-                    common.send_receive(serverdata[sid]["host"],serverdata[sid]["port"], vars(args)))
-                    if "status" in responses[i] and responses[i]["status"]=="ok":
-                        print responses[i]
-                        break
-                    i+=1
-                else: print "No such key found in our system"
-            elif args.cmd=="setr":
-                responses=common.broadcast_receive(aloc,serverdata,vars(args))
-                for r in responses:
-                    if "epoch" in r:
-                        epoch=r["epoch"]
-                for r in responses:
-                    if "error" in r:
-                        print "Set failed: server connection error"
-                        send_cancel(args.key,args.val,aloc,serverdata)
-                        break
-                    elif r["vote"]=="no":
-                        print "Set failed: server voted no"
-                        send_cancel(args.key,args.val,aloc,serverdata)
-                        break
-                    elif r["epoch"]!=epoch:
-                        print "Set failed: epoch inconsistency"
-                        send_cancel(args.key,args.val,aloc,serverdata)
-                        break
-                else:
-                    send_commit(args.key,args.val,aloc,serverdata)
-                    return
-
-
+            print result
+    elif args.cmd=="msetr":
+        print client.msetr(pairs_to_items(args.pairs), args.w).result()
+    elif args.cmd=="scan":
+        scan=client.scan(args.prefix, args.start, args.end, args.order, args.values, args.limit)
+        for found in scan:
+            print found
+        for (sid, error) in scan.errors.items():
+            print "Scan of %s failed: %s" % (sid or "the view", error)
+    elif args.cmd=="mset":
+        request={"cmd": "mset", "items": pairs_to_items(args.pairs)}
+        print client.call_server(request).result()
+    elif args.cmd=="mget":
+        print client.call_server({"cmd": "mget", "keys": args.keys}).result()
+    elif args.cmd=="set":
+        print client.set(args.key, args.val).result()
+    elif args.cmd=="get":
+        print client.get(args.key).result()
+    elif args.cmd=="print":
+        print client.call_server({"cmd": "print", "text": args.text}).result()
     else:
-        response = common.send_receive_range(args.server, common2.SERVER_LOW, common2.SERVER_HIGH, vars(args))
-        print response
+        print client.call_server({"cmd": args.cmd}).result()
+    client.close()
 
 if __name__ == "__main__":
     main()    
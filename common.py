@@ -1,86 +1,655 @@
+import os
+import time
+import random
+import atexit
 import json
 import socket
 import struct
 import hashlib
+import bisect
+import heapq
+import select
+import threading
+import Queue
+import codec
 import common2
 
-MAX_MESSAGE_SIZE = 8192
-HASH_MAX = 100000
+# Positions on the hash ring are HASH_BITS-bit integers
+HASH_BITS = 32
+HASH_MAX = 2 ** HASH_BITS
+POSITION = struct.Struct("!I")
+
+# seconds to wait for a connection, or for the reply to a request
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 5
+
+# seconds a message on a client connection may take to send; a peer that
+# stops reading then costs the connection, not every caller's wait
+SEND_TIMEOUT = 5
+TIMEVAL = struct.Struct("ll")
+
+# Every message travels in frames. A legacy frame is a 4-byte length
+# followed by the whole JSON body; as it is always shorter than FRAME_SIZE,
+# its first byte is zero. A tagged frame starts with FRAME_MAGIC instead
+# and carries flags and a request ID, so that several requests can be in
+# flight on one connection and replies can come back in any order:
+#   magic (1 byte) | flags (1 byte) | request ID (4 bytes) | length (4 bytes)
+# A peer always replies with the same kind of frame it was sent.
+FRAME_MAGIC = 0xD5
+FRAME_HEADER = struct.Struct("!BBII")
+LEGACY_HEADER = struct.Struct("!i")
+
+# Tagged frames carry at most FRAME_SIZE bytes; a longer message is split
+# over several frames, all but the last flagged FLAG_CHUNK. A streamed
+# reply is a series of messages, all but the last flagged FLAG_STREAM.
+# A legacy frame holds a whole message, which must fit in FRAME_SIZE.
+FRAME_SIZE = 8192
+FLAG_CHUNK = 0x01
+FLAG_STREAM = 0x02
+
+# The top four bits of a tagged frame's flags give the codec of its
+# payload (see codec.py). Legacy frames are always JSON.
+CODEC_SHIFT = 4
+
+# codec new connections use, if their server speaks it, and whether
+# peers are trusted with codecs that aren't safe on hostile input
+CODEC = codec.NAMES[common2.CODEC]
+TRUST_PEERS = common2.TRUST_PEERS
+
+# default limit on the size of a single message, in either direction; it
+# can be set per connection
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Read exactly n bytes from a socket. Raises EOFError if the peer closed
+# the connection cleanly before the first byte, socket.error otherwise.
+def recv_exact(sock, n):
+    data = sock.recv(n, socket.MSG_WAITALL)
+    if not data and n:
+        raise EOFError("connection closed")
+    while len(data) < n:
+        more = sock.recv(n - len(data), socket.MSG_WAITALL)
+        if not more:
+            raise socket.error("connection closed mid-frame")
+        data += more
+    return data
+
+# Write one frame. A request ID of None writes a legacy frame.
+def send_frame(sock, rid, payload, flags=0):
+    if rid is None:
+        sock.sendall(LEGACY_HEADER.pack(len(payload)) + payload)
+    else:
+        sock.sendall(FRAME_HEADER.pack(FRAME_MAGIC, flags, rid, len(payload)) + payload)
+
+# Read one frame of at most limit bytes, returning (request ID, flags,
+# payload). The request ID is None for a legacy frame.
+def receive_frame(sock, limit=MAX_MESSAGE_SIZE):
+    head = recv_exact(sock, LEGACY_HEADER.size)
+    if ord(head[0]) == FRAME_MAGIC:
+        head += recv_exact(sock, FRAME_HEADER.size - LEGACY_HEADER.size)
+        (magic, flags, rid, nlen) = FRAME_HEADER.unpack(head)
+    elif ord(head[0]) == 0:
+        (rid, flags) = (None, 0)
+        nlen = LEGACY_HEADER.unpack(head)[0]
+        limit = min(limit, FRAME_SIZE - 1)
+    else:
+        raise socket.error("invalid frame header")
+    if nlen > limit:
+        raise socket.error("invalid message size %s" % nlen)
+    return (rid, flags, recv_exact(sock, nlen))
+
+# Write an encoded message, in as many frames as it takes. The caller
+# must keep other writers off the socket until it returns. With a
+# deadline, a message still being sent at that time fails with
+# socket.timeout, whatever progress it is making.
+def send_message(sock, rid, payload, flags=0, deadline=None):
+    if rid is None:
+        send_frame(sock, None, payload)
+        return
+    last = max(0, (len(payload) - 1) // FRAME_SIZE)
+    for i in range(last + 1):
+        if deadline is not None and time.time() > deadline:
+            raise socket.timeout("send timed out")
+        chunk = payload[i * FRAME_SIZE:(i + 1) * FRAME_SIZE]
+        send_frame(sock, rid, chunk, flags | (FLAG_CHUNK if i < last else 0))
+
+# Read a whole message of at most max_size bytes, returning (request ID,
+# flags, payload); the flags are those of the message, less FLAG_CHUNK.
+def receive_message(sock, max_size=MAX_MESSAGE_SIZE):
+    (rid, flags, payload) = receive_frame(sock, max_size)
+    if not flags & FLAG_CHUNK:
+        return (rid, flags, payload)
+    chunks = [payload]
+    size = len(payload)
+    while flags & FLAG_CHUNK:
+        (chunk_rid, flags, payload) = receive_frame(sock, max_size - size)
+        if chunk_rid != rid:
+            raise socket.error("interleaved message chunks")
+        chunks.append(payload)
+        size += len(payload)
+    return (rid, flags, "".join(chunks))
+
+# Folds one part of a streamed reply into the parts received before it:
+# dicts under the same key are merged and lists concatenated, anything
+# else is replaced. Returns the merged reply.
+def merge_parts(merged, part):
+    if merged is None:
+        return part
+    for key in part:
+        if isinstance(merged.get(key), dict) and isinstance(part[key], dict):
+            merged[key].update(part[key])
+        elif isinstance(merged.get(key), list) and isinstance(part[key], list):
+            merged[key].extend(part[key])
+        else:
+            merged[key] = part[key]
+    return merged
+
+# A streamed reply. A handler may return Stream(parts), for an iterable of
+# dicts, to send a large reply in bounded pieces as they are produced.
+# Unless the client asks to see the parts one by one, it merges them
+# back together with merge_parts.
+class Stream(object):
+    def __init__(self, parts):
+        self.parts = parts
 
 # Encode and send a message on an open socket
-def send(sock, message):
+def send(sock, message, rid=None):
     message = json.dumps(message).encode()
 
-    nlen = len(message)
-    if nlen >= MAX_MESSAGE_SIZE:
+    if rid is None and len(message) >= FRAME_SIZE:
         return {"error": "maxmimum message size exceeded"}
-    slen = struct.pack("!i", nlen)
-
-    if sock.sendall(slen) is not None:
-        return {"error", "incomplete message"}
-    if sock.sendall(message) is not None:
-        return {"error", "incompletely sent message"}
+    try:
+        send_message(sock, rid, message)
+    except socket.error:
+        return {"error": "incompletely sent message"}
 
     return {}
 
 # Expect a message on an open socket
 def receive(sock):
-    nlen = sock.recv(4, socket.MSG_WAITALL)
-    if not nlen:
+    try:
+        (rid, flags, response) = receive_message(sock)
+    except (EOFError, socket.error):
         return {"error": "can't receive"}
 
-    slen = (struct.unpack("!i", nlen)[0])
-    if slen >= MAX_MESSAGE_SIZE:
-        return {"error": "maximum response size exceeded"}
-    response = sock.recv(slen, socket.MSG_WAITALL)
-
     return json.loads(response.decode())
 
-def send_receive_range(host, port_low, port_high, message):
-    for port in range(port_low, port_high):
-        response = send_receive(host, port, message)
+# Sends message to whichever port of [port_low, port_high) the service on
+# host answers on. The port found is remembered (see ports), so only the
+# first call for a range has to look for it.
+def send_receive_range(host, port_low, port_high, message, timeout=REQUEST_TIMEOUT,
+        on_part=None):
+    key = port_key(host, port_low, port_high)
+    with ports_lock:
+        port = ports.get(key)
+    if port is not None:
+        response = send_receive(host, port, message, timeout, on_part)
+        if "error" not in response:
+            return response
+        forget_port(key)
+    for port in probe_ports(host, port_low, port_high):
+        response = send_receive(host, port, message, timeout, on_part)
         if "error" in response:
             continue
         else:
+            remember_port(key, port)
             return response
     else:
         return {"error": "can't connect to %s" % host}
 
+# The ports found by send_receive_range, by host and port range. A port
+# that fails a request is forgotten, and the range looked through again.
+# With port_cache set (use_port_cache), they are also saved in that file,
+# so that short-lived processes such as the client find them too.
+ports = {}
+ports_lock = threading.Lock()
+port_cache = None
+
+def port_key(host, port_low, port_high):
+    return "%s:%s-%s" % (host, port_low, port_high)
+
+def use_port_cache(path):
+    global port_cache
+    port_cache = path or None
+    if port_cache is None:
+        return
+    try:
+        with open(port_cache) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return
+    if isinstance(saved, dict):
+        with ports_lock:
+            ports.update(saved)
+
+def remember_port(key, port):
+    with ports_lock:
+        if ports.get(key) == port:
+            return
+        ports[key] = port
+    save_ports()
+
+def forget_port(key):
+    with ports_lock:
+        if ports.pop(key, None) is None:
+            return
+    save_ports()
+
+def save_ports():
+    if port_cache is None:
+        return
+    with ports_lock:
+        saved = dict(ports)
+    tmp = "%s.%s" % (port_cache, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            json.dump(saved, f)
+        os.rename(tmp, port_cache)
+    except (IOError, OSError) as e:
+        print "Can't save port cache: %s" % e
+
+# Connects to every port of a range at once, and yields the ports that
+# accepted, lowest first: the order a scan one port at a time would have
+# found them in, without paying for each refused or unanswered port in
+# turn. The connections are pooled, so the request that follows reuses
+# the one it is sent on.
+def probe_ports(host, port_low, port_high):
+    probes = [(port, spawn(connect, host, port)) for port in range(port_low, port_high)]
+    for (port, probe) in probes:
+        if isinstance(probe.result(CONNECT_TIMEOUT + 1), Connection):
+            yield port
+
+# A minimal future: the pending result of an asynchronous operation.
+# Results follow the RPC convention, so a timed out wait returns a dict
+# with an "error" key rather than raising.
+class Future(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    # Returns False if the future already had a result
+    def set_result(self, result):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._result = result
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            return {"error": "timed out"}
+        return self._result
+
+    # fn(future) runs once the result is set, immediately if it already is
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+# A persistent client connection. Requests are tagged with a request ID,
+# so any number of them may share the socket; a reader thread matches
+# replies to the futures waiting for them.
+class Connection(object):
+    def __init__(self, host, port, max_size=None, codec_id=None):
+        self.address = (host, port)
+        # largest message accepted or sent on this connection
+        self.max_size = max_size or MAX_MESSAGE_SIZE
+        # codec requests are sent in; replaced by the one replies come in
+        self.codec = CODEC if codec_id is None else codec_id
+        self.sock = socket.create_connection((host, port), CONNECT_TIMEOUT)
+        # reads block for as long as the connection is open; sends time
+        # out (SO_SNDTIMEO), without a socket timeout that would apply to
+        # the reader too
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+            TIMEVAL.pack(SEND_TIMEOUT, 0))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.alive = True
+        # guards the request counter and the pending table, and is never
+        # held across socket I/O, so that deadlines can always fire
+        self.lock = threading.Lock()
+        # keeps other writers off the socket while a message is sent
+        self.send_lock = threading.Lock()
+        self.next_rid = 1
+        self.pending = {}
+        start_helper(self.read_loop)
+
+    # Send a message, returning a Reply future. If the message never
+    # reached the socket, the result carries "unsent". on_part, if given,
+    # is called with each part of a streamed reply as it arrives. With a
+    # timeout, the reply fails if it, or the next part of a streamed one,
+    # hasn't come within that many seconds.
+    def submit(self, message, on_part=None, timeout=None):
+        future = Reply(on_part)
+        codec_id = future.codec = self.codec
+        try:
+            payload = codec.encode(codec_id, message)
+        except (TypeError, ValueError) as e:
+            future.set_result({"error": "encoding error %s" % e})
+            return future
+        if len(payload) > self.max_size:
+            future.set_result({"error": "maxmimum message size exceeded"})
+            return future
+        with self.lock:
+            if not self.alive:
+                future.set_result({"error": "can't send to %s:%s because "
+                    "connection closed" % self.address, "unsent": True})
+                return future
+            future.rid = rid = self.next_rid
+            self.next_rid = (self.next_rid + 1) & 0xffffffff or 1
+            self.pending[rid] = future
+        # the deadline runs from before the send, so it covers a send
+        # stuck behind others on the same connection
+        if timeout is not None:
+            timeouts.add(timeout, self.expire, future, timeout, future.parts)
+        try:
+            with self.send_lock:
+                send_message(self.sock, rid, payload, codec_id << CODEC_SHIFT,
+                    time.time() + SEND_TIMEOUT)
+        except socket.error as e:
+            # a send that timed out may have left part of a frame behind,
+            # so the connection can't be used again
+            with self.lock:
+                self.pending.pop(rid, None)
+            self.close(e)
+            future.set_result({"error": "can't send to %s:%s because %s"
+                % (self.address + (e,)), "unsent": True})
+        return future
+
+    # The timeout of a reply passed; it fails unless a part of it came
+    # since the timeout was set, in which case it gets another
+    def expire(self, future, timeout, seen):
+        if future.done():
+            return
+        if future.parts != seen:
+            timeouts.add(timeout, self.expire, future, timeout, future.parts)
+            return
+        with self.lock:
+            self.pending.pop(future.rid, None)
+        future.set_result({"error": "no reply from %s:%s within %ss"
+            % (self.address + (timeout,))})
+
+    # Send a message and wait for its reply. A streamed reply may take
+    # longer than timeout in total, as long as no gap between parts does.
+    # A request the server couldn't decode, because it doesn't speak our
+    # codec, is sent again in the codec it answered in.
+    def request(self, message, timeout=REQUEST_TIMEOUT, on_part=None):
+        future = self.submit(message, on_part, timeout)
+        # an untimed wait: a timed one polls in Python 2, and would add up
+        # to 50 ms to every reply
+        response = future.result()
+        if future.codec != self.codec and response.get("unsupported_codec"):
+            return self.request(message, timeout, on_part)
+        return response
+
+    def read_loop(self):
+        reason = "connection closed"
+        try:
+            while True:
+                (rid, flags, payload) = receive_message(self.sock, self.max_size)
+                last = not flags & FLAG_STREAM
+                codec_id = flags >> CODEC_SHIFT
+                accepted = codec.accepts(codec_id, TRUST_PEERS)
+                with self.lock:
+                    if accepted:
+                        self.codec = codec_id
+                    if last:
+                        future = self.pending.pop(rid, None)
+                    else:
+                        future = self.pending.get(rid)
+                if future is None:
+                    continue
+                try:
+                    if not accepted:
+                        raise ValueError("reply in untrusted codec %s" % codec_id)
+                    future.add_part(codec.decode(codec_id, payload), last)
+                except (KeyError, ValueError) as e:
+                    with self.lock:
+                        self.pending.pop(rid, None)
+                    future.set_result({"error": "decoding error %s" % e})
+        except (EOFError, socket.error) as e:
+            reason = e
+        self.close(reason)
+
+    # Shut the connection and fail every request still waiting on it
+    def close(self, reason="connection closed"):
+        with self.lock:
+            if not self.alive:
+                return
+            self.alive = False
+            waiting, self.pending = self.pending, {}
+        with pool_lock:
+            if pool.get(self.address) is self:
+                del pool[self.address]
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for future in waiting.values():
+            future.set_result({"error": "connection to %s:%s lost: %s"
+                % (self.address + (reason,))})
+
+# The Future of a request sent on a Connection. A streamed reply is
+# merged part by part, or handed to on_part, in which case the result is
+# just the last part.
+class Reply(Future):
+    def __init__(self, on_part=None):
+        Future.__init__(self)
+        self.rid = None
+        self.on_part = on_part
+        self.parts = 0
+        self.merged = None
+
+    def add_part(self, part, last):
+        self.parts += 1
+        if self.on_part is not None:
+            self.on_part(part)
+            self.merged = part
+        else:
+            self.merged = merge_parts(self.merged, part)
+        if last:
+            self.set_result(self.merged)
+
+# Deadlines for requests, kept by one thread for all of them, so that no
+# request waits with a timed wait (which in Python 2 polls, and would
+# delay its reply) or needs a timer thread of its own. add() calls
+# fn(*args) on that thread once delay seconds have passed; fn should be
+# quick, and is called whether or not the request is still waiting.
+class Timeouts(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        # (deadline, sequence number, fn, args)
+        self.heap = []
+        self.count = 0
+        self.thread = None
+        self.stopped = False
+
+    def add(self, delay, fn, *args):
+        with self.cond:
+            self.count += 1
+            heapq.heappush(self.heap, (time.time() + delay, self.count, fn, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.heap[0][1] == self.count:
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                now = time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+                if not due:
+                    # polls, but only this thread waits on it
+                    self.cond.wait(self.heap[0][0] - now)
+                    continue
+            for (deadline, count, fn, args) in due:
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print "timeout handler error: %s" % e
+
+    # Stops the thread, waiting for it until the time end
+    def stop(self, end):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join(max(0, end - time.time()))
+
+timeouts = Timeouts()
+
+# Connection pool, keyed by (host, port)
+pool = {}
+pool_lock = threading.Lock()
+
+# Threads started by this module: connection readers and spawned calls.
+# At exit the pool is closed and they are given a moment to finish, so
+# that none of them wakes up in a half torn-down interpreter.
+helpers = set()
+helpers_lock = threading.Lock()
+
+def start_helper(fn):
+    def run():
+        try:
+            fn()
+        finally:
+            with helpers_lock:
+                helpers.discard(thread)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    with helpers_lock:
+        helpers.add(thread)
+    thread.start()
+
+def shutdown():
+    with pool_lock:
+        conns = pool.values()
+    for conn in conns:
+        conn.close("shutting down")
+    end = time.time() + 1
+    with helpers_lock:
+        threads = list(helpers)
+    for thread in threads:
+        thread.join(max(0, end - time.time()))
+    timeouts.stop(end)
+
+atexit.register(shutdown)
+
+# Return a live pooled connection to host:port, opening one if needed.
+# Raises socket.error if the connection can't be made.
+def connect(host, port):
+    address = (host, port)
+    with pool_lock:
+        conn = pool.get(address)
+    if conn is not None and conn.alive:
+        return conn
+    conn = Connection(host, port)
+    with pool_lock:
+        current = pool.get(address)
+        if current is not None and current.alive:
+            extra, conn = conn, current
+        else:
+            extra = None
+            pool[address] = conn
+    if extra is not None:
+        extra.close()
+    return conn
 
 # Encapsulates the send/receive functionality of an RPC client
 # Parameters
 #   host, port - host and port to connect to
 #   message - arbitrary Python object to be sent as message
+#   timeout - seconds to wait for the reply
+#   on_part - if given, called with each part of a streamed reply, which
+#     is then not merged; the return value is the last part
 # Return value
 #   Response received from server
 #   In case of error, returns a dict containing an "error" key
-def send_receive(host, port, message):
-    sock = None
-    try:
-        sock = socket.create_connection((host, port), 5)
-        if not sock:
-            return {"error": "can't connect to %s:%s" % (host, port)}
+# Connections are kept open in the pool and reused by later calls. A
+# pooled connection the peer has since dropped is replaced once.
+def send_receive(host, port, message, timeout=REQUEST_TIMEOUT, on_part=None):
+    for attempt in range(2):
+        try:
+            conn = connect(host, port)
+        except socket.error as e:
+            return {"error": "can't connect to %s:%s because %s" % (host, port, e)}
+        response = conn.request(message, timeout, on_part)
+        if not response.get("unsent"):
+            return response
+    return response
 
-        send_result = send(sock, message)
-        if "error" in send_result:
-            return send_result
+# A fixed set of worker threads fed from a bounded queue. submit() blocks
+# while the queue is full, which pushes back on whoever is producing work.
+class WorkerPool(object):
+    def __init__(self, workers, queue_size=0):
+        self.tasks = Queue.Queue(queue_size)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
 
-        receive_result = receive(sock)
-        return receive_result
+    # Run fn(*args) on a worker, returning a Future for its result
+    def submit(self, fn, *args):
+        future = Future()
+        self.tasks.put((future, fn, args))
+        return future
 
-    except ValueError as e: 
-        return {"error": "json encoding error %s" % e}
-    except socket.error as e:
-        return {"error": "can't connect to %s:%s because %s" % (host, port, e)}
-    finally:
-        if sock is not None:
-            sock.close()
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            (future, fn, args) = task
+            try:
+                result = fn(*args)
+            except Exception as e:
+                result = {"error": "worker error: %s" % e}
+            future.set_result(result)
+
+    # Stop the workers once the tasks already queued are done
+    def close(self):
+        for thread in self.threads:
+            self.tasks.put(None)
+
+# An accepted connection on the server side. With a worker pool several
+# replies may be written to it at once, so writes take the lock.
+class Peer(object):
+    def __init__(self, sock, addr, max_size=MAX_MESSAGE_SIZE):
+        self.sock = sock
+        self.addr = addr
+        self.max_size = max_size
+        self.lock = threading.Lock()
 
 # A simple RPC server
 # Parameters
 #   port - port number to listen on for all interfaces
 #   handler - function to handle respones, documented below
 #   timeout - if not None, after how many seconds to invoke timeout handler
+#   workers - if nonzero, how many threads handle requests concurrently
+#   backlog - how many pending connections the kernel may queue
+#   max_size - largest message accepted or sent on each connection
 # Return value
 #   in case of error, returns a dict with "error" key
 #   otherwise, function does not return until timeout handler returns "abort"
@@ -91,76 +660,228 @@ def send_receive(host, port, message):
 #    init: the port has been bound, please perform server initializiation
 #    timeout: timeout occurred
 #    anything else: RPC command received
-# the return value of the handler function is sent as an RPC response
-def listen(port, handler, timeout=None):
+# the return value of the handler function is sent as an RPC response;
+# it may be a Stream to send the response in parts, or a Future, to send
+# its result whenever it is set (from any thread)
+#
+# Accepted connections stay open, and every request arriving on them is
+# answered. With workers=0 requests are handled one at a time on the
+# listening thread; otherwise they are handed to a pool of that many
+# threads, so the handler must protect any state it shares. Either way
+# init and timeout run on the listening thread, and the timeout handler
+# runs when no connection has had any activity for timeout seconds.
+# Requests in a codec that isn't safe on hostile input are only decoded
+# if trusted; others are told the codec isn't spoken, so they fall back
+# to JSON.
+def listen(port, handler, timeout=None, workers=0, backlog=1,
+        max_size=MAX_MESSAGE_SIZE, trusted=None):
+    if trusted is None:
+        trusted = TRUST_PEERS
     bindsock = None
+    workpool = None
+    # open client connections, mapped to their Peer
+    conns = {}
+    # a worker that gets "abort" back from the handler records the response
+    # and writes to the pipe to wake the listening thread
+    aborted = []
+    (wake_r, wake_w) = os.pipe()
+
+    def work(peer, rid, msg, codec_id):
+        response = reply(peer, rid, msg, handler, codec_id)
+        if "abort" in response:
+            aborted.append(response)
+            os.write(wake_w, "!")
+
     try:
         bindsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # connections closed by a previous server on this port linger in
+        # TIME_WAIT; don't let them keep a restarted server from binding
+        bindsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         bindsock.bind(('', port))
-        bindsock.listen(1)
-        if timeout:
-            bindsock.settimeout(timeout)
+        bindsock.listen(backlog)
 
         if "abort" in handler({"cmd":"init", "port": port}, None):
             return {"error": "listen: abort in init"}
-
-        sock = None
-        addr = None
+        if workers:
+            workpool = WorkerPool(workers, workers * 4)
 
         while True:
-            try:
-                sock, (addr, accepted_port) = bindsock.accept()
-
-                nlen = sock.recv(4, socket.MSG_WAITALL)
-                if not nlen:
-                    print "listen: invalid length"
-                    continue
+            if aborted:
+                print "listen: abort"
+                return aborted[0]
+            readable = select.select([bindsock, wake_r] + conns.keys(), [], [], timeout)[0]
+            if not readable:
+                if "abort" in handler({"cmd":"timeout"}, None):
+                    return {"error": "listen: abort in timeout"}
+                continue
 
-                slen = struct.unpack("!i", nlen)[0]
-                if slen >= MAX_MESSAGE_SIZE:
-                    print "listen: invalid message size %s" % slen
+            for sock in readable:
+                if sock is wake_r:
+                    os.read(wake_r, 512)
                     continue
-                msg = sock.recv(slen, socket.MSG_WAITALL)
-                if not msg:
-                    print "listen: receive failed"
+                if sock is bindsock:
+                    try:
+                        sock, (addr, accepted_port) = bindsock.accept()
+                        sock.settimeout(CONNECT_TIMEOUT)
+                        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        conns[sock] = Peer(sock, addr, max_size)
+                    except socket.error as e:
+                        print "listen: socket error %s" % e
                     continue
-
-                jsonmsg = json.loads(msg)
-
+                peer = conns[sock]
                 try:
-                    response = handler(jsonmsg, addr)
-                    if "abort" in response:
-                        print "listen: abort"
-                        return response
-                        break
-                except Exception as e: #Break for testing
-                    print "listen: handler error: %s" % e
+                    (rid, flags, msg) = receive_message(sock, max_size)
+                    codec_id = flags >> CODEC_SHIFT
+                    if not codec.accepts(codec_id, trusted):
+                        write(peer, rid, {"error": "unsupported codec %s" % codec_id,
+                            "unsupported_codec": True}, 0, codec.JSON)
+                        continue
+                    message = codec.decode(codec_id, msg)
+                except EOFError:
+                    drop(sock, conns)
                     continue
-
-                json_response = json.dumps(response)
-                slen = struct.pack("!i", len(json_response))
-                sock.sendall(slen)
-                sock.sendall(json_response)
-            except socket.timeout:
-                if "abort" in handler({"cmd":"timeout"}, None):
-                    return {"error": "listen: abort in timeout"}
-            except ValueError as e: #Break for testing
-                print "listen: json encoding error %s" % e
-            except socket.error as e:
-                print "listen: socket error %s" % e
-            finally:
-                if sock is not None:
-                    sock.close()
+                except ValueError as e: #Break for testing
+                    print "listen: decoding error %s" % e
+                    drop(sock, conns)
+                    continue
+                except socket.error as e:
+                    print "listen: socket error %s" % e
+                    drop(sock, conns)
+                    continue
+                if workpool is not None:
+                    workpool.submit(work, peer, rid, message, codec_id)
+                    continue
+                response = reply(peer, rid, message, handler, codec_id)
+                if "abort" in response:
+                    print "listen: abort"
+                    return response
     except socket.error as e:
         return {"error": "can't bind %s" % e}
     finally:
+        if workpool is not None:
+            workpool.close()
+        for sock in conns:
+            sock.close()
         if bindsock is not None:
             bindsock.close()
+        os.close(wake_r)
+        os.close(wake_w)
+
+# Dispatch one request to the handler and write the reply in the same kind
+# of frame, and the same codec, the request came in. Returns the handler
+# response.
+def reply(peer, rid, msg, handler, codec_id=codec.JSON):
+    try:
+        response = handler(msg, peer.addr)
+    except Exception as e: #Break for testing
+        print "listen: handler error: %s" % e
+        response = {"error": "handler error: %s" % e}
+    if isinstance(response, Stream):
+        reply_stream(peer, rid, response, codec_id)
+        return {}
+    if isinstance(response, Feed):
+        response.attach(peer, rid, codec_id)
+        return {}
+    if isinstance(response, Future):
+        response.add_done_callback(
+            lambda future: write(peer, rid, future.result(), 0, codec_id))
+        return {}
+    if "abort" in response:
+        return response
+
+    write(peer, rid, response, 0, codec_id)
+    return response
+
+# A reply that goes on for as long as the handler likes, in parts pushed
+# to it from any thread: a subscription. The handler returns it with its
+# first part, and each push() sends another, tagged as a streamed reply
+# to the request, so the requestor gets them through send_receive's
+# on_part. push() returns False once the connection has failed, after
+# which the feed should be dropped. A legacy peer can't take a stream,
+# so it gets the first part as its whole reply.
+class Feed(object):
+    def __init__(self, first):
+        self.lock = threading.Lock()
+        # parts pushed before the feed was attached to its connection
+        self.parts = [first]
+        self.target = None
+        self.alive = True
+
+    def attach(self, peer, rid, codec_id):
+        with self.lock:
+            self.target = (peer, rid, codec_id)
+            (parts, self.parts) = (self.parts, [])
+            if rid is None:
+                write(peer, rid, parts[0], 0, codec_id)
+                self.alive = False
+                return
+            for part in parts:
+                self.send(part)
+
+    def push(self, part):
+        with self.lock:
+            if self.target is None:
+                self.parts.append(part)
+            elif self.alive:
+                self.send(part)
+            return self.alive
+
+    # (caller holds the lock)
+    def send(self, part):
+        (peer, rid, codec_id) = self.target
+        if self.alive and not write(peer, rid, part, FLAG_STREAM, codec_id):
+            self.alive = False
+
+# Send each part of a streamed response as soon as the next one is ready,
+# so the last can go without FLAG_STREAM. A legacy peer can't take a
+# stream, so it gets the parts merged into one message.
+def reply_stream(peer, rid, stream, codec_id):
+    previous = None
+    try:
+        for part in stream.parts:
+            if rid is None:
+                previous = merge_parts(previous, part)
+                continue
+            if previous is not None and not write(peer, rid, previous, FLAG_STREAM, codec_id):
+                return
+            previous = part
+    except Exception as e: #Break for testing
+        print "listen: handler error: %s" % e
+        if previous is not None and rid is not None:
+            write(peer, rid, previous, FLAG_STREAM, codec_id)
+        previous = {"error": "handler error: %s" % e}
+    write(peer, rid, previous or {}, 0, codec_id)
+
+# Encode and send one response message. Returns False if the connection
+# failed.
+def write(peer, rid, message, flags=0, codec_id=codec.JSON):
+    try:
+        payload = codec.encode(codec_id, message)
+    except (TypeError, ValueError) as e:
+        payload = codec.encode(codec_id, {"error": "encoding error %s" % e})
+    limit = peer.max_size if rid is not None else FRAME_SIZE - 1
+    if len(payload) > limit:
+        payload = codec.encode(codec_id, {"error": "maximum response size exceeded"})
+    try:
+        with peer.lock:
+            send_message(peer.sock, rid, payload, flags | codec_id << CODEC_SHIFT)
+    except socket.error as e:
+        print "listen: socket error %s" % e
+        return False
+    return True
+
+def drop(sock, conns):
+    del conns[sock]
+    sock.close()
 
-# hash function for creating server IDs and allocating keys.
+# hash function for creating server IDs and allocating keys. The
+# position is the low HASH_BITS bits of the key's SHA-1, which is the
+# full digest modulo HASH_MAX. Unicode keys hash as their UTF-8 bytes, so
+# a key hashes the same whichever codec delivered it.
 def hash_key(d):
-    sha1 = hashlib.sha1(d)
-    return int(sha1.hexdigest(),16) % HASH_MAX
+    if isinstance(d, unicode):
+        d = d.encode("utf-8")
+    return POSITION.unpack_from(hashlib.sha1(d).digest(), 20 - POSITION.size)[0]
 
 # function to convert the formatted "address:port" string
 # to an (address, port) tuple.
@@ -177,68 +898,568 @@ def formatHP(hp):
             port+=c
     return((host, int(port)))
 
+# The consistent-hash ring for one view, built once and then queried in
+# O(log n) with bisect. Each server has vnodes points on the ring: its own
+# ID, and vnodes-1 more derived from it, which evens out the share of the
+# ring each server gets. A key whose hash is h is stored on the first
+# `replication` distinct servers found walking clockwise from h; with one
+# point per server that is the first servers whose IDs are larger than h,
+# wrapping around past HASH_MAX.
+#
+# The points split the ring into segments, [points[i-1], points[i]) ending
+# at each point (the first one wraps around zero); every key in a segment
+# has the same replicas, which are worked out once when the ring is built.
+class Ring(object):
+    def __init__(self, sids, vnodes=None, replication=None):
+        if vnodes is None:
+            vnodes = common2.VNODES
+        if replication is None:
+            replication = common2.REPLICATION
+        self.sids = sorted(set(sids))
+        self.replication = min(replication, len(self.sids))
+        points = sorted((point, sid) for sid in self.sids
+            for point in vnode_points(sid, vnodes))
+        self.points = [point for (point, sid) in points]
+        owners = [sid for (point, sid) in points]
+        # replicas[i] is the list of servers for the segment ending at points[i]
+        self.replicas = []
+        n = len(owners)
+        for i in xrange(n):
+            replicas = []
+            j = i
+            while len(replicas) < self.replication:
+                if owners[j] not in replicas:
+                    replicas.append(owners[j])
+                j = j + 1 if j + 1 < n else 0
+            if self.replicas and self.replicas[-1] == replicas:
+                replicas = self.replicas[-1]
+            self.replicas.append(replicas)
+
+    # The servers storing keys that hash to h, in clockwise order
+    def replicas_for(self, h):
+        if not self.points:
+            return []
+        i = bisect.bisect_right(self.points, h)
+        return self.replicas[i if i < len(self.points) else 0]
+
+    # The servers storing key k
+    def allocate(self, k):
+        return self.replicas_for(hash_key(k))
+
+    def covers(self, sid, h):
+        return sid in self.replicas_for(h)
+
+    # The arc [lo, hi) cut at the ring's points, as ([lo, hi), replicas)
+    # pairs in order. It bisects into the ring, so it costs the segments
+    # the arc spans rather than a walk of every point, as arcs does.
+    def segments(self, lo, hi):
+        pieces = []
+        n = len(self.points)
+        while n and lo < hi:
+            i = bisect.bisect_right(self.points, lo)
+            end = min(hi, self.points[i] if i < n else HASH_MAX)
+            pieces.append(([lo, end], self.replicas[i if i < n else 0]))
+            lo = end
+        return pieces
+
+    # The parts of the ring whose keys sid stores, as a sorted list of
+    # non-overlapping [lo, hi) arcs. This replaces the single lower bound
+    # a server had with one point per server.
+    def arcs(self, sid):
+        if sid not in self.sids:
+            return []
+        if len(self.sids) <= self.replication:
+            return [[0, HASH_MAX]]
+        arcs = []
+        for i in xrange(len(self.points)):
+            if sid not in self.replicas[i]:
+                continue
+            if i == 0:
+                arcs.append([self.points[-1], HASH_MAX])
+                arcs.append([0, self.points[0]])
+            else:
+                arcs.append([self.points[i - 1], self.points[i]])
+        return merge_arcs(arcs)
+
+# Points on the ring for server sid
+def vnode_points(sid, vnodes):
+    return [sid] + [hash_key("%s#%s" % (sid, i)) for i in range(1, vnodes)]
+
+# Sorts a list of [lo, hi) arcs and merges those that overlap or touch,
+# dropping empty ones
+def merge_arcs(arcs):
+    merged = []
+    for (lo, hi) in sorted(arcs):
+        if lo >= hi:
+            continue
+        if merged and lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return merged
+
+# The parts of the ring in both of two merged arc lists
+def intersect_arcs(a, b):
+    both = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        lo = max(a[i][0], b[j][0])
+        hi = min(a[i][1], b[j][1])
+        if lo < hi:
+            both.append([lo, hi])
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return both
+
+# The parts of the ring in merged arc list a but not in b
+def subtract_arcs(a, b):
+    rest = []
+    j = 0
+    for (lo, hi) in a:
+        while j < len(b) and b[j][1] <= lo:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] < hi:
+            if b[k][0] > lo:
+                rest.append([lo, b[k][0]])
+            lo = max(lo, b[k][1])
+            k += 1
+        if lo < hi:
+            rest.append([lo, hi])
+    return rest
+
+# Rings for recently seen views, keyed by the view's server IDs in the
+# order they were given. Every RPC about a view carries it in the same
+# order, so the ring is built once per view rather than per call.
+rings = {}
+rings_lock = threading.Lock()
+RING_CACHE_SIZE = 8
+
+def ring_for(sids):
+    key = tuple(sids)
+    with rings_lock:
+        ring = rings.get(key)
+    if ring is None:
+        ring = Ring(sids)
+        with rings_lock:
+            if len(rings) >= RING_CACHE_SIZE:
+                rings.clear()
+            rings[key] = ring
+    return ring
+
 # the bucket allocator is used by the client to determine which
 # servers should store a key. k is the key, sids is the list of 
 # all server IDs.
 def bucket_allocator(k,sids):
-    if len(sids)<common2.REPLICATION:
-        return sids
-    h=hash_key(k)
-    sids.sort()
-    if h>sids[-1]:
-        return sids[0:3]
-    elif h>sids[-2]:
-        return [sids[-1], sids[0], sids[1]]
-    elif h>sids[-3]:
-        return [sids[-2], sids[-1], sids[0]]
-    else:
-        for i in range(len(sids)):
-            if h<sids[i]:
-                return[sids[i],sids[i+1], sids[i+2]]
-
-# lowBound takes a server ID sid and the view of all server IDs,
-# including sid, and returns the server ID that is REPLICATION number
-# of steps to the "left" (or counterclockwise, or whichever metaphor).
-def lowBound(sid,sids):
-    if len(sids)>common2.REPLICATION: 
-        sids.sort()
-        i=sids.index(sid)
-        return (sids[i-common2.REPLICATION], i)
-    else: 
-        return sid
-
-# 'i' represents the position of the server in question 
-# within the ordered list of server hashes. If i-replication
-# is a negaitive number, then the server's coverage area
-# loops around the zero line. 
+    return ring_for(sids).allocate(k)
+
+# coverageFn returns a filter on key hashes, true for those that server
+# sid stores in the view sids.
 def coverageFn(sid,sids):
-    if len(sids)>common2.REPLICATION: 
-        (n3ighbor,i)=lowBound(sid,sids)
-        if i-common2.REPLICATION < 0:
-            return lambda x : True if x>n3ighbor or x<sid else False
-        else:
-            return lambda x : True if x>n3ighbor and x<sid else False
-    else:
-        return lambda x : True
+    ring = ring_for(sids)
+    return lambda x : ring.covers(sid, x)
 
-# broadcast receive sequentially performs send_receive on a list of servers, and 
-# then returns a lost of their responses.
-def broadcast_receive(sids, serverdata, msg):
-    responses=[]
-    i=0
+# Calls fn(*args) on a helper thread after delay seconds, unless the Event
+# returned is set first. Unlike threading.Timer, the thread is one of the
+# helpers that are waited for at exit.
+def after(delay, fn, *args):
+    cancelled = threading.Event()
+    def run():
+        cancelled.wait(delay)
+        if not cancelled.is_set():
+            fn(*args)
+    start_helper(run)
+    return cancelled
+
+# Run fn(*args) on a new thread, returning a Future for its result
+def spawn(fn, *args):
+    future = Future()
+    def run():
+        try:
+            result = fn(*args)
+        except Exception as e:
+            result = {"error": "%s" % e}
+        future.set_result(result)
+    start_helper(run)
+    return future
+
+# broadcast receive performs send_receive on a list of servers concurrently,
+# and returns a list of their responses, in the same order as sids.
+# Parameters
+#   deadline - if not None, seconds to wait for the responses
+#   until - optional predicate on the responses so far (None where a
+#     server hasn't answered yet); as soon as it returns True the
+#     broadcast returns without waiting for the others
+# Servers that haven't answered by then are reported with an "error" key.
+# Their requests are not recalled, only no longer waited for.
+def broadcast_receive(sids, serverdata, msg, deadline=None, until=None):
+    return gather([(sid, msg) for sid in sids], serverdata, deadline, until)
+
+# Sends msg to each of sids concurrently, without waiting for the replies
+def broadcast_send(sids, serverdata, msg):
     for sid in sids:
+        spawn(send_receive, serverdata[sid]["host"], serverdata[sid]["port"], msg)
+
+# multicast receive is broadcast_receive with a different message for each
+# server: msgs maps server IDs to messages. Returns a dict of server ID to
+# response.
+def multicast_receive(msgs, serverdata, deadline=None):
+    sids = msgs.keys()
+    responses = gather([(sid, msgs[sid]) for sid in sids], serverdata, deadline)
+    return dict(zip(sids, responses))
+
+# Sends each (server ID, message) request concurrently; see
+# broadcast_receive.
+def gather(requests, serverdata, deadline=None, until=None):
+    responses = [None] * len(requests)
+    cond = threading.Condition()
+    # expired[0] is set when the deadline passes
+    expired = [False]
+
+    def arrived(i):
+        def callback(future):
+            with cond:
+                responses[i] = future.result()
+                cond.notify()
+        return callback
+
+    def expire():
+        with cond:
+            expired[0] = True
+            cond.notify()
+
+    # the deadline is enforced by a timer rather than a timed wait, which
+    # in Python 2 wakes by polling
+    timer = None
+    if deadline is not None:
+        timer = threading.Timer(deadline, expire)
+        timer.daemon = True
+        timer.start()
+    i = 0
+    for (sid, msg) in requests:
         host=serverdata[sid]["host"]
         port=serverdata[sid]["port"]
-        responses.insert(i,
-        send_receive(host,port, msg))
-        if "error" in responses[i]:
-            #print {"fail":responses[i], "server":sid} #TESTING
-            pass
+        spawn(send_receive, host, port, msg).add_done_callback(arrived(i))
         i+=1
-    return responses
 
+    with cond:
+        while None in responses and not expired[0]:
+            if until is not None and until(responses):
+                break
+            cond.wait()
+        result = list(responses)
+        reason = "deadline passed" if expired[0] else "broadcast ended early"
+    if timer is not None:
+        timer.cancel()
+
+    for i in range(len(result)):
+        if result[i] is None:
+            result[i] = {"error": "no response from %s: %s" % (requests[i][0], reason)}
+    return result
+
+# Builds an "until" predicate for broadcast_receive that stops as soon as
+# n responses satisfy ok, or so many of the `of` servers asked (n, by
+# default) have failed it that n no longer can.
+def quorum(n, ok=lambda r: "error" not in r, of=None):
+    if of is None:
+        of = n
+    def reached(responses):
+        answered = [r for r in responses if r is not None]
+        good = len([r for r in answered if ok(r)])
+        return good >= n or len(answered) - good > of - n
+    return reached
+
+##############
+# Replica reads
+# Latencies of recent requests to each server, used to choose which
+# replica of a key to read from first, and how long to give it before
+# asking the next one too. A request that fails counts as taking
+# REQUEST_TIMEOUT, so an unreachable server sinks to the back.
+LATENCY_SAMPLES = 64
+
+class LatencyTracker(object):
+    def __init__(self, size=LATENCY_SAMPLES):
+        self.size = size
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, sid, seconds):
+        with self.lock:
+            samples = self.samples.setdefault(sid, [])
+            samples.append(seconds)
+            if len(samples) > self.size:
+                del samples[0]
+
+    # The p'th percentile of sid's recent latencies, or None if there are
+    # none
+    def percentile(self, sid, p):
+        with self.lock:
+            samples = sorted(self.samples.get(sid, []))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    # sids with the fastest (by median latency) first. Servers not heard
+    # from yet go first, so that they get measured.
+    def order(self, sids):
+        def median(sid):
+            m = self.percentile(sid, 50)
+            return 0 if m is None else m
+        return sorted(sids, key=median)
+
+    # How long to wait on sid before hedging
+    def hedge_delay(self, sid):
+        delay = self.percentile(sid, common2.HEDGE_PERCENTILE)
+        return common2.HEDGE_DELAY if delay is None else delay
+
+    # The samples, to save between runs, and to load them back
+    def state(self):
+        with self.lock:
+            return dict((str(sid), list(samples)) for (sid, samples) in self.samples.items())
+
+    def load(self, state):
+        with self.lock:
+            for (sid, samples) in state.items():
+                self.samples[int(sid)] = list(samples)[-self.size:]
+
+latency = LatencyTracker()
 
+# send_receive to server sid, recording how long it took
+def timed_request(sid, serverdata, msg):
+    start = time.time()
+    response = send_receive(serverdata[sid]["host"], serverdata[sid]["port"], msg)
+    latency.record(sid, REQUEST_TIMEOUT if "error" in response else time.time() - start)
+    return response
 
-            
+# Reads from the replicas sids of a key until count of them (a read
+# quorum) give a response that satisfies ok. Returns those responses, and
+# a dict of every response received by server ID. mode is one of
+#   "sequential" - the replicas one after another, in the order given
+#   "hedge" - the fastest count replicas first; if one hasn't answered
+#     within its common2.HEDGE_PERCENTILE latency, the next one as well,
+#     and so on. A replica that fails is followed up at once.
+#   "all" - every replica at once
+# The first good responses win. Requests still in flight then are left
+# to finish on their own and their responses are discarded, and no more
+# hedges are sent.
+def read_replicas(sids, serverdata, msg, mode=None, ok=lambda r: r.get("status") == "ok",
+        count=1):
+    if mode is None:
+        mode = common2.READ_MODE
+    if mode == "sequential":
+        responses = {}
+        winners = []
+        for sid in sids:
+            responses[sid] = timed_request(sid, serverdata, msg)
+            if ok(responses[sid]):
+                winners.append(responses[sid])
+            if len(winners) >= count:
+                break
+        return (winners, responses)
 
+    order = latency.order(sids)
+    cond = threading.Condition()
+    responses = []
+    senders = []
+    launched = [0]
+    finished = [False]
+    timers = []
 
+    def arrived(sid):
+        def callback(future):
+            with cond:
+                responses.append(future.result())
+                senders.append(sid)
+                cond.notify()
+        return callback
+
+    # sends the next request; caller holds cond
+    def launch():
+        sid = order[launched[0]]
+        launched[0] += 1
+        spawn(timed_request, sid, serverdata, msg).add_done_callback(arrived(sid))
+        if mode == "hedge" and launched[0] < len(order):
+            timers.append(after(latency.hedge_delay(sid), hedge, launched[0]))
+
+    # the hedge delay of the n'th request passed
+    def hedge(n):
+        with cond:
+            if not finished[0] and launched[0] == n:
+                launch()
+
+    with cond:
+        while launched[0] < (len(order) if mode == "all" else min(count, len(order))):
+            launch()
+        while True:
+            winners = [r for r in responses if ok(r)]
+            if len(winners) >= count or len(responses) == len(order):
+                finished[0] = True
+                break
+            if (launched[0] < len(order) and
+                    len(winners) + launched[0] - len(responses) < count):
+                # too many of the requests sent so far have failed
+                launch()
+                continue
+            cond.wait()
+        result = dict(zip(senders, responses))
+    for timer in timers:
+        timer.set()
+    return (winners[:count], result)
+
+##############
+# Replicated sets
+# A replicated set is a two-phase commit: every replica of a key votes on
+# it (setr, or msetr for many keys), and it is then committed on all of
+# them if all voted yes in the same epoch, and canceled otherwise.
+#
+# Every transaction has an ID, which is also the version of the values it
+# writes: the time in milliseconds, with random low bits to tell apart
+# transactions started in the same millisecond. A replica keeps the value
+# with the highest version, so replicas agree whatever order commits
+# reach them in.
+def new_version():
+    return (int(time.time() * 1000) << 20) | random.getrandbits(20)
+
+# A view's epoch carries the viewleader's generation, the time it started
+# in seconds, in its high bits, and the count of view changes since then
+# in the low EPOCH_BITS. Compared as numbers they order by (generation,
+# count), so the epochs of a restarted viewleader come after those of the
+# one it replaced, although its count starts again from zero.
+EPOCH_BITS=32
+
+def first_epoch():
+    return int(time.time()) << EPOCH_BITS
+
+def epoch_generation(epoch):
+    return epoch >> EPOCH_BITS
+
+voted_yes=lambda r : r.get("vote")=="yes"
+
+stale=lambda r : r.get("status")=="stale_epoch"
+
+# Decides a replicated set from the replicas' votes: returns None if it
+# should be committed, otherwise why it has to be canceled. It needs yes
+# votes from w replicas (all of them, by default; see common2.WRITE_QUORUM)
+# in the same epoch.
+def setr_failure(responses, w=None):
+    if w is None:
+        w=len(responses)
+    yes=[r for r in responses if voted_yes(r)]
+    epochs=set(r["epoch"] for r in yes)
+    if any(stale(r) for r in responses):
+        return "stale view"
+    elif len(epochs)>1:
+        return "epoch inconsistency"
+    elif len(yes)>=w:
+        return None
+    elif any(r.get("vote")=="no" for r in responses):
+        return "server voted no"
+    elif any("error" in r for r in responses):
+        return "server connection error"
+    return "too few votes"
+
+# Whether a failed operation might succeed with a fresh view: a server
+# said the epoch it was sent is out of date, or couldn't be reached
+def view_outdated(responses):
+    return any(stale(r) or "error" in r for r in responses)
+
+# Turns a query_servers response into the server IDs, a dict of their
+# host and port, and the epoch of the view
+def parse_view(view):
+    server_ids=[]
+    serverdata={}
+    for server in view["result"]:
+        (h,p)=formatHP(server["location"])
+        n=int(server["name"])
+        server_ids.append(n)
+        serverdata[n]={"host": h, "port": p}
+    return (server_ids, serverdata, view["epoch"])
+
+# Follows the viewleader's view of the servers for as long as the
+# process runs, so it wants a thread of its own. It subscribes to the
+# view, and calls on_view(view, change) whenever the epoch moves on,
+# with the view as query_servers gives it. change is the delta the
+# viewleader sent ("joined" servers and the names of those that "left"),
+# or None for a whole view. A subscription that drops is taken up again
+# after VIEW_RESUBSCRIBE seconds, starting over from a whole view.
+VIEW_RESUBSCRIBE = 1
+
+def follow_view(viewleader, on_view):
+    while True:
+        view = {}
+        def on_part(part):
+            if "result" in part:
+                view.clear()
+                view.update(part)
+                on_view(dict(view), None)
+            elif "result" in view and part.get("epoch") > view["epoch"]:
+                left = set(part.get("left", []))
+                view["result"] = [server for server in view["result"]
+                    if server["name"] not in left] + part.get("joined", [])
+                view["epoch"] = part["epoch"]
+                on_view(dict(view), part)
+        send_receive_range(viewleader, common2.VIEWLEADER_LOW, common2.VIEWLEADER_HIGH,
+            {"cmd": "subscribe"}, REQUEST_TIMEOUT, on_part)
+        time.sleep(VIEW_RESUBSCRIBE)
+
+# Replicated set of many keys at once, as one transaction. Every server
+# gets a single msetr prepare for all the keys it is a replica of, then at
+# most one mcommit and one mcancel; each key commits if w of its replicas
+# (common2.WRITE_QUORUM by default) voted yes in the same epoch, on those
+# replicas. Returns the outcome for each key ("ok", "failed: why" or
+# "commit incomplete"), and the failed keys that might succeed with a
+# fresher view than server_ids.
+def replicated_set(items, server_ids, serverdata, epoch=None, txid=None, w=None):
+    if txid is None:
+        txid=new_version()
+    if w is None:
+        w=common2.WRITE_QUORUM
+    ring=ring_for(server_ids)
+    alocs={}
+    prepares={}
+    for key in items:
+        alocs[key]=ring.allocate(key)
+        for sid in alocs[key]:
+            prepares.setdefault(sid, {"cmd": "msetr", "items": {}, "epoch": epoch,
+                "txid": txid})["items"][key]=items[key]
+    votes=multicast_receive(prepares, serverdata)
+
+    results={}
+    commits={}
+    cancels={}
+    for key in items:
+        responses=[]
+        for sid in alocs[key]:
+            r=votes[sid]
+            if "votes" in r:
+                r={"vote": r["votes"][key], "epoch": r["epoch"]}
+            responses.append(r)
+        failure=setr_failure(responses, min(w, len(responses)))
+        if failure is not None:
+            results[key]="failed: %s" % failure
+        for (sid, r) in zip(alocs[key], responses):
+            if failure is None and voted_yes(r):
+                (decisions, cmd)=(commits, "mcommit")
+            else:
+                (decisions, cmd)=(cancels, "mcancel")
+            decisions.setdefault(sid, {"cmd": cmd, "keys": [], "txid": txid})["keys"].append(key)
+
+    # the cancels aren't waited for: a replica that misses one drops the
+    # prepare when it expires
+    spawn(multicast_receive, cancels, serverdata)
+    committed=multicast_receive(commits, serverdata)
+    outdated=[]
+    for key in items:
+        if key in results:
+            if view_outdated([votes[sid] for sid in alocs[key]]):
+                outdated.append(key)
+            continue
+        done=0
+        for sid in alocs[key]:
+            r=committed.get(sid, {})
+            if key in r.get("results", {}) and r["results"][key]["status"]=="ok":
+                done+=1
+        results[key]="ok" if done>=min(w, len(alocs[key])) else "commit incomplete"
+    return {"results": results, "outdated": outdated}
@@ -7,5 +7,79 @@ VIEWLEADER_LOW = 39000
 VIEWLEADER_HIGH = 39010
 
 LOCK_LEASE = 20
+
+# how often, in seconds, the viewleader tells subscribers to the view
+# that nothing changed, so that they know their subscription is alive;
+# well under common.REQUEST_TIMEOUT
+VIEW_KEEPALIVE = 2
+# how long the viewleader goes on denying a lease to a server whose lease
+# expired, in seconds, and how many such servers it remembers at most
+EXPIRED_RETENTION = 24 * 3600
+EXPIRED_MAX = 100000
+
+# the viewleader rebalances once the view has gone this many seconds
+# without changing, or this long after the first change, whichever is
+# sooner
+REBALANCE_SETTLE = 1.0
+REBALANCE_MAX_DELAY = 5.0
 REPLICATION = 3
-#3 is hard coded into the "bucket_allocator" function
\ No newline at end of file
+
+# how long a lock_get may be parked at the viewleader waiting for the
+# lock, in seconds, before it is answered "retry"
+LOCK_WAIT = 30
+
+# of a key's REPLICATION replicas, how many must commit a replicated set
+# (W) and how many a replicated get reads (R). With R + W > REPLICATION
+# every read overlaps the latest write; lower values trade that for
+# latency. Replicas that miss a write are brought up to date by repair.
+WRITE_QUORUM = 3
+READ_QUORUM = 1
+
+# points each server has on the consistent-hash ring
+VNODES = 16
+
+# request handling threads per server and viewleader, and the size of
+# the kernel's queue of not-yet-accepted connections
+WORKERS = 8
+LISTEN_BACKLOG = 64
+
+# threads a dhtclient.Client runs replicated operations on; more of them
+# than this queue for one
+CLIENT_WORKERS = 32
+
+# wire codec new connections use: "json" or "binary" (see codec.py).
+# Binary is only decoded by processes that trust their peers, so it takes
+# TRUST_PEERS on both ends; a peer that doesn't trust us answers that it
+# doesn't speak binary, and the connection falls back to JSON.
+CODEC = "json"
+
+# whether anything that can reach this process's ports, and anything it
+# connects to, is one of this cluster's own processes. Only then may it
+# decode codecs that aren't safe on hostile input.
+TRUST_PEERS = False
+
+# where clients cache the view between runs, and the ports they found
+# the viewleader and servers on
+VIEW_CACHE = "~/.dht_view_cache"
+PORT_CACHE = "~/.dht_port_cache"
+
+# how clients read a key from its replicas: "hedge", "all" or "sequential"
+# (see common.read_replicas). A hedged read asks the next replica once
+# the first has taken longer than this percentile of its recent
+# latencies, or HEDGE_DELAY seconds before there are any.
+READ_MODE = "hedge"
+HEDGE_PERCENTILE = 95
+HEDGE_DELAY = 0.05
+
+# whether getr skips the replicas whose Bloom filters (bloom.py) say they
+# don't have the key, and for how many seconds a client uses the filters
+# it fetched. Filters reach the viewleader with heartbeats, so a key
+# written by another client in the last few seconds may be missed.
+BLOOM_READS = False
+BLOOM_TTL = 10
+
+# whether servers send their filters to the viewleader at all (or
+# server.py --publish-bloom). A filter is about 1.7 MB per million keys,
+# so only clusters whose clients read with them should publish them;
+# without filters, bloom reads ask every replica.
+BLOOM_PUBLISH = BLOOM_READS
@@ -0,0 +1,500 @@
+import os
+import json
+import time
+import heapq
+import itertools
+import socket
+import threading
+import common
+import common2
+import bloom
+
+# A client of the DHT for programs to use, rather than running client.py
+# once per operation. A Client keeps the view, the ports it found the
+# viewleader and its server on, and its connections (pooled in common)
+# from one operation to the next. Its operations return common.Futures,
+# so a program can have many of them in flight at once:
+#
+#   client = dhtclient.Client()
+#   futures = [client.setr("k%d" % i, "v") for i in range(1000)]
+#   results = [future.result() for future in futures]
+#
+# Results follow the RPC convention: a dict, with an "error" key if the
+# operation failed. Waiting on .result() is the synchronous way to use a
+# Client; add_done_callback is the way to use it without blocking.
+#
+# get, set, lock_get, lock_release, call_server/call_viewleader and the
+# pages of a scan go out straight away on a pooled connection, and take
+# no thread while they wait for their reply, so any number of them may
+# be in flight; a deadline kept by common.timeouts fails any that gets
+# no reply in time. The replicated operations (getr, setr, msetr) take
+# several rounds of RPCs to a key's replicas, and each runs on one of a
+# pool of worker threads (common2.CLIENT_WORKERS), queueing for one if
+# they are all busy.
+#
+# With a view_cache file, the view is also kept on disk, along with the
+# latencies measured to each server (common.latency), for the next
+# Client to start from; see client.py. With subscribe set, the Client
+# subscribes to the view at the viewleader, and has every new view
+# pushed to it as soon as the viewleader has it, rather than finding out
+# from a server that its view is stale.
+class Client(object):
+    def __init__(self, server="localhost", viewleader="localhost", view_cache=None,
+            port_cache=None, workers=None, subscribe=False):
+        self.server = server
+        self.viewleader = viewleader
+        self.view_cache = view_cache
+        if port_cache:
+            common.use_port_cache(port_cache)
+        self.pool = common.WorkerPool(workers or common2.CLIENT_WORKERS)
+        # guards the view and the filters; fetching is held while a new
+        # view is fetched
+        self.lock = threading.Lock()
+        self.fetching = threading.Lock()
+        # the last query_servers response, parsed by common.parse_view,
+        # and the Bloom filters that came with it, by server ID
+        self.view = None
+        self.parsed = None
+        self.filters = {}
+        cached = self.load_cache()
+        common.latency.load(cached.get("latency", {}))
+        if cached.get("view") is not None:
+            self.set_view(cached["view"])
+        if subscribe:
+            follower = threading.Thread(target=common.follow_view,
+                args=(self.viewleader, self.follow_view))
+            follower.daemon = True
+            follower.start()
+
+    # Stops the workers once the operations queued for them are done, and
+    # saves the view
+    def close(self):
+        self.pool.close()
+        self.save_view()
+
+    ##############
+    # Requests
+
+    # Sends msg to the service on one of the ports [port_low, port_high)
+    # of host, as common.send_receive_range does, returning a Future for
+    # the response. Once the port is known the request goes straight out
+    # on its connection; finding the port, or finding it again when the
+    # request fails, is left to a worker.
+    def request(self, host, port_low, port_high, msg, timeout=common.REQUEST_TIMEOUT):
+        with common.ports_lock:
+            port = common.ports.get(common.port_key(host, port_low, port_high))
+        search = lambda : self.pool.submit(common.send_receive_range, host, port_low,
+            port_high, msg, timeout)
+        if port is None:
+            return search()
+        return self.direct(host, port, msg, timeout, search)
+
+    # Sends msg to host:port, as common.send_receive does, returning a
+    # Future for the response
+    def send(self, host, port, msg, timeout=common.REQUEST_TIMEOUT):
+        return self.direct(host, port, msg, timeout,
+            lambda : self.pool.submit(common.send_receive, host, port, msg, timeout))
+
+    # Sends msg on the pooled connection to host:port. If there is none
+    # and one can't be opened, or the request fails, retry() is called
+    # for a Future of the response instead.
+    def direct(self, host, port, msg, timeout, retry):
+        try:
+            reply = common.connect(host, port).submit(msg, None, timeout)
+        except socket.error:
+            return retry()
+        future = common.Future()
+        def answered(reply):
+            response = reply.result()
+            if "error" in response:
+                retry().add_done_callback(lambda again : future.set_result(again.result()))
+            else:
+                future.set_result(response)
+        reply.add_done_callback(answered)
+        return future
+
+    def call_server(self, msg, timeout=common.REQUEST_TIMEOUT):
+        return self.request(self.server, common2.SERVER_LOW, common2.SERVER_HIGH, msg, timeout)
+
+    def call_viewleader(self, msg, timeout=common.REQUEST_TIMEOUT):
+        return self.request(self.viewleader, common2.VIEWLEADER_LOW, common2.VIEWLEADER_HIGH,
+            msg, timeout)
+
+    # Unreplicated get and set, on this client's server
+    def get(self, key):
+        return self.call_server({"cmd": "get", "key": key})
+
+    def set(self, key, val):
+        return self.call_server({"cmd": "set", "key": key, "val": val})
+
+    # Takes a lock, answering when it is ours. The viewleader holds each
+    # request for up to wait seconds until it is (0 polls every
+    # LOCK_POLL seconds instead), and it is asked again for as long as it
+    # answers "retry"; on_retry, if given, is called with each such
+    # answer. With a lease, the lock (or our place in its queue) is let go
+    # unless lock_get is called again within that many seconds.
+    def lock_get(self, lockid, requestor, wait=None, lease=None, on_retry=None):
+        if wait is None:
+            wait = common2.LOCK_WAIT
+        msg = {"cmd": "lock_get", "lockid": lockid, "requestor": requestor, "wait": wait,
+            "lease": lease}
+        future = common.Future()
+        def answered(reply):
+            response = reply.result()
+            if response.get("status") != "retry":
+                future.set_result(response)
+                return
+            if on_retry is not None:
+                on_retry(response)
+            if wait:
+                ask()
+            else:
+                common.after(LOCK_POLL, ask)
+        def ask():
+            self.call_viewleader(msg, common.REQUEST_TIMEOUT + wait).add_done_callback(answered)
+        ask()
+        return future
+
+    def lock_release(self, lockid, requestor):
+        return self.call_viewleader({"cmd": "lock_release", "lockid": lockid,
+            "requestor": requestor})
+
+    ##############
+    # Replicated operations
+
+    # Replicated get, from whichever replicas answer first; see
+    # common.read_replicas for the read modes. The result is the newest
+    # replica's answer, {"status": "not_found"}, or an error if no replica
+    # could answer at all. With a read quorum r of one, a replica without
+    # the key doesn't settle the read, as it may just have missed the
+    # write. With more, it is one of the quorum's answers, the newest
+    # version among them wins, and the replicas that answered with an
+    # older one are repaired. With bloom_reads, the replicas whose filters
+    # say they don't have the key are skipped.
+    def getr(self, key, r=None, read_mode=None, bloom_reads=None):
+        if r is None:
+            r = common2.READ_QUORUM
+        if bloom_reads is None:
+            bloom_reads = common2.BLOOM_READS
+        def op(view, final):
+            (server_ids, serverdata, epoch) = view
+            aloc = common.bucket_allocator(key, server_ids)
+            if bloom_reads:
+                with self.lock:
+                    filters = self.filters
+                aloc = [sid for sid in aloc if sid not in filters or key in filters[sid]]
+                if not aloc:
+                    return {"status": "not_found"}
+            msg = {"cmd": "getr", "key": key, "epoch": epoch}
+            found = lambda response : response.get("status") == "ok"
+            answered = lambda response : found(response) or response.get("status") == "not_found"
+            quorum = min(r, len(aloc))
+            (answers, responses) = common.read_replicas(aloc, serverdata, msg, read_mode,
+                found if quorum == 1 else answered, quorum)
+            values = [answer for answer in answers if found(answer)]
+            if values:
+                newest = max(values, key=lambda answer : answer.get("version", 0))
+                if len(answers) > 1:
+                    read_repair(key, newest, responses, serverdata)
+                return newest
+            result = {"status": "not_found"}
+            if not any(answered(response) for response in responses.values()):
+                # no replica could say whether it has the key
+                if any(common.stale(response) for response in responses.values()):
+                    result = {"error": "stale view"}
+                else:
+                    result = {"error": "no replica answered"}
+            if not final and len(answers) < quorum and common.view_outdated(responses.values()):
+                return Stale(result)
+            return result
+        return self.pool.submit(self.with_view, op, bloom_reads)
+
+    # Replicated set, committed once w replicas (common2.WRITE_QUORUM by
+    # default) vote yes. The result has the version written and the
+    # replicas' commit responses.
+    def setr(self, key, val, w=None):
+        if w is None:
+            w = common2.WRITE_QUORUM
+        def op(view, final):
+            (server_ids, serverdata, epoch) = view
+            aloc = common.bucket_allocator(key, server_ids)
+            txid = common.new_version()
+            quorum = min(w, len(aloc))
+            msg = {"cmd": "setr", "key": key, "val": val, "epoch": epoch, "txid": txid}
+            # stop waiting for votes as soon as w replicas say yes, or too
+            # many say no for that to happen
+            responses = common.broadcast_receive(aloc, serverdata, msg,
+                until=common.quorum(quorum, common.voted_yes, len(aloc)))
+            failure = common.setr_failure(responses, quorum)
+            if failure is None:
+                # replicas that are still to vote get the commit too, and
+                # apply it if their vote was yes
+                commits = send_commit(key, txid, [sid for (sid, response) in zip(aloc, responses)
+                    if response.get("vote") != "no"], serverdata, quorum)
+                self.note_writes([key], server_ids)
+                return {"status": "ok", "version": txid, "commits": commits}
+            send_cancel(key, txid, aloc, serverdata)
+            if not final and common.view_outdated(responses):
+                return Stale({"error": failure})
+            return {"error": failure}
+        return self.pool.submit(self.with_view, op)
+
+    # Replicated set of many keys, as one transaction (see
+    # common.replicated_set). The keys that failed for want of an up to
+    # date view are tried again, once, with a fresh one. The result has
+    # the outcome for each key.
+    def msetr(self, items, w=None):
+        items = dict(items)
+        results = {}
+        def op(view, final):
+            (server_ids, serverdata, epoch) = view
+            outcome = common.replicated_set(items, server_ids, serverdata, epoch, w=w)
+            results.update(outcome["results"])
+            self.note_writes([key for (key, result) in outcome["results"].items()
+                if result == "ok"], server_ids)
+            if not final and outcome["outdated"]:
+                for key in items.keys():
+                    if key not in outcome["outdated"]:
+                        del items[key]
+                return Stale({"results": results})
+            return {"results": results}
+        return self.pool.submit(self.with_view, op)
+
+    # Iterates over the keys of the whole cluster that match prefix and
+    # the [start, end) key range, in ring order or in key order (order
+    # "key"); with values, over (key, entry) pairs. See Scan.
+    def scan(self, prefix=None, start=None, end=None, order="ring", values=False, limit=None):
+        msg = {"cmd": "scan", "prefix": prefix, "start": start, "end": end, "order": order,
+            "values": values, "limit": limit}
+        return Scan(self, msg)
+
+    ##############
+    # The view
+    # Servers turn away replicated operations that carry an older epoch
+    # than theirs, so the view is used until a server says it is stale,
+    # and only then is the viewleader asked again.
+
+    # Runs op(view, final) with the view, parsed. If op fails in a way a
+    # fresher view might fix, it returns Stale; the view is fetched again,
+    # and if the viewleader has moved on to a newer epoch, op runs once
+    # more with it, this time with final set. A replica that is just down
+    # leaves the epoch as it was, and the failure stands. Returns what op
+    # returns, or an error if there is no view to run it with.
+    def with_view(self, op, bloom_reads=False):
+        view = self.get_view(bloom_reads=bloom_reads)
+        if "error" in view:
+            return view
+        result = op(self.parsed_view(view), False)
+        if isinstance(result, Stale):
+            fresh = self.get_view(stale=view, bloom_reads=bloom_reads)
+            if "error" in fresh or fresh["epoch"] <= view["epoch"]:
+                return result.result
+            result = op(self.parsed_view(fresh), True)
+        return result
+
+    # The view, fetched from the viewleader if there is none yet, or the
+    # one there is is stale: the view an operation found out of date. If
+    # another operation has replaced that one meanwhile, the replacement
+    # is used instead, and only one operation at a time fetches a view,
+    # so that operations that need a new one together ask the viewleader
+    # for it once. A view without servers is fetched again too, as servers
+    # may have joined since. With bloom_reads, a view without the servers'
+    # filters, or with filters older than common2.BLOOM_TTL, is fetched
+    # again with them. Runs on a worker, so the viewleader is asked on this
+    # thread.
+    def get_view(self, stale=None, bloom_reads=False):
+        def outdated(view):
+            return view is None or view is stale or not view["result"] or (bloom_reads and
+                (not view.get("bloom") or time.time() - view.get("time", 0) > common2.BLOOM_TTL))
+        with self.lock:
+            view = self.view
+        if outdated(view):
+            with self.fetching:
+                with self.lock:
+                    view = self.view
+                if outdated(view):
+                    view = common.send_receive_range(self.viewleader, common2.VIEWLEADER_LOW,
+                        common2.VIEWLEADER_HIGH, {"cmd": "query_servers", "bloom": bloom_reads})
+                    if "error" in view:
+                        return {"error": "viewleader failure: %s" % view["error"]}
+                    # when it was fetched, and whether with the filters
+                    view["time"] = time.time()
+                    view["bloom"] = bloom_reads
+                    self.set_view(view)
+                    self.save_view()
+        if view["result"] == []:
+            return {"error": "no servers available"}
+        return view
+
+    # A view pushed by the viewleader, which comes without filters
+    def follow_view(self, view, change):
+        view["time"] = time.time()
+        view["bloom"] = False
+        self.set_view(view)
+
+    def set_view(self, view):
+        filters = dict((int(server["name"]), bloom.Bloom(server["bloom"]))
+            for server in view["result"] if "bloom" in server)
+        parsed = common.parse_view(view)
+        with self.lock:
+            (self.view, self.parsed, self.filters) = (view, parsed, filters)
+
+    def parsed_view(self, view):
+        with self.lock:
+            if view is self.view:
+                return self.parsed
+        return common.parse_view(view)
+
+    # The Bloom filters of the servers' keys that came with the view are
+    # as old as the view plus a heartbeat, so a key written since may be
+    # missing from them; getr with bloom_reads takes that risk, for at most
+    # common2.BLOOM_TTL seconds, to skip the replicas that don't have a
+    # key. The keys this client writes are added to them.
+    def note_writes(self, keys, server_ids):
+        with self.lock:
+            filters = self.filters
+        if not filters:
+            return
+        ring = common.ring_for(server_ids)
+        with self.lock:
+            for key in keys:
+                for sid in ring.allocate(key):
+                    if sid in filters:
+                        filters[sid].add(key)
+
+    # The view cache holds the view and latencies of each viewleader, in
+    # JSON, and may be shared by several processes: it is read whole and
+    # replaced whole.
+    def load_cache(self):
+        if not self.view_cache:
+            return {}
+        try:
+            with open(self.view_cache) as f:
+                return json.load(f).get(self.viewleader, {})
+        except (IOError, ValueError, AttributeError):
+            return {}
+
+    # Saves the view, with the filters as they are now, and the latencies
+    # measured so far
+    def save_view(self):
+        if not self.view_cache:
+            return
+        with self.lock:
+            view = self.view
+            filters = dict((sid, f.snapshot()) for (sid, f) in self.filters.items())
+        try:
+            with open(self.view_cache) as f:
+                views = json.load(f)
+        except (IOError, ValueError):
+            views = {}
+        if not isinstance(views, dict):
+            views = {}
+        cached = views.get(self.viewleader)
+        if not isinstance(cached, dict):
+            cached = {}
+        if view is not None:
+            view = dict(view, result=[dict(server, bloom=filters[int(server["name"])])
+                if int(server["name"]) in filters else server for server in view["result"]])
+            cached["view"] = view
+        cached["latency"] = common.latency.state()
+        views[self.viewleader] = cached
+        tmp = "%s.%s.%s" % (self.view_cache, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, "w") as f:
+                json.dump(views, f)
+            os.rename(tmp, self.view_cache)
+        except (IOError, OSError) as e:
+            print "Can't save view cache: %s" % e
+
+# An iteration over the keys of every server in the view, by way of their
+# scan RPCs (see server.scan). Every server's keys are read a page at a
+# time, each page asked for as soon as the one before arrives, and the
+# servers' pages are merged in order. A key on several replicas comes up
+# once, with the newest of their entries. At most two pages per server
+# are held at once, whatever the size of the cluster's store.
+#
+# A server that can't be reached, or fails partway through, is left out,
+# as its keys are on other replicas too; errors says which and why, by
+# server ID, once the iteration is done.
+class Scan(object):
+    def __init__(self, client, msg):
+        self.client = client
+        self.msg = msg
+        self.errors = {}
+
+    def __iter__(self):
+        view = self.client.get_view()
+        if "error" in view:
+            self.errors[None] = view["error"]
+            return
+        (server_ids, serverdata, epoch) = self.client.parsed_view(view)
+        # every server's first page is asked for at once
+        streams = [self.server_keys(sid, serverdata, self.fetch(sid, serverdata, None))
+            for sid in server_ids]
+        for (order, copies) in itertools.groupby(heapq.merge(*streams), lambda item : item[0]):
+            copies = list(copies)
+            key = copies[0][1]
+            if self.msg["values"]:
+                yield (key, max((entry for (order, key, entry) in copies),
+                    key=lambda entry : entry.get("version", 0)))
+            else:
+                yield key
+
+    def fetch(self, sid, serverdata, cursor):
+        return self.client.send(serverdata[sid]["host"], serverdata[sid]["port"],
+            dict(self.msg, cursor=cursor))
+
+    # The keys of server sid, page by page, as (order, key, entry), where
+    # order is what the pages are sorted by
+    def server_keys(self, sid, serverdata, future):
+        while future is not None:
+            page = future.result()
+            if "error" in page:
+                self.errors[sid] = page["error"]
+                return
+            cursor = page.get("cursor")
+            future = None if cursor is None else self.fetch(sid, serverdata, cursor)
+            entries = page.get("entries") or [None] * len(page["keys"])
+            for (key, entry) in zip(page["keys"], entries):
+                yield (self.order(key), key, entry)
+
+    def order(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        if self.msg["order"] == "key":
+            return key
+        return (common.hash_key(key), key)
+
+# What an operation run by Client.with_view returns when it failed, maybe
+# for want of an up to date view; result is the failure, which stands if
+# there is no newer view to try again with
+class Stale(object):
+    def __init__(self, result):
+        self.result = result
+
+# seconds between lock_get requests when the viewleader doesn't hold them
+LOCK_POLL = 5
+
+# Commits a replicated set on the replicas aloc, waiting for w of them
+# (all, by default) to acknowledge it, and returns their responses
+def send_commit(key, txid, aloc, serverdata, w=None):
+    committed = lambda response : response.get("status") == "ok"
+    return common.broadcast_receive(aloc, serverdata, {"key": key, "txid": txid, "cmd": "commit"},
+        until=common.quorum(w or len(aloc), committed, len(aloc)))
+
+# Cancels a replicated set on the replicas aloc. Nothing waits for the
+# replies, so a replica that is down costs nothing here; one that misses
+# the cancel drops the prepare when it expires.
+def send_cancel(key, txid, aloc, serverdata):
+    common.broadcast_send(aloc, serverdata, {"key": key, "txid": txid, "cmd": "cancel"})
+
+# Sends the newest value of a key to the replicas that answered a read
+# with an older one, or without it. They keep it only if it is still
+# newer than what they have when it arrives.
+def read_repair(key, newest, responses, serverdata):
+    entry = {"val": newest["value"], "version": newest.get("version", 0)}
+    stale = [sid for (sid, response) in responses.items()
+        if response.get("status") == "not_found" or
+            (response.get("status") == "ok" and response.get("version", 0) < entry["version"])]
+    if stale:
+        common.broadcast_receive(stale, serverdata, {"cmd": "repair", "items": {key: entry}})
@@ -0,0 +1,357 @@
+import array
+import bisect
+import random
+import common
+
+# A server's key/value store. It works like the dict of entries it
+# replaced (store[key] is the {"val": ..., "version": ...} entry), but it
+# also keeps an index of the keys sorted by their position on the hash
+# ring, so that an arc of the ring can be read off in O(log n + k) by
+# bisecting the index, instead of rehashing every key in the store.
+#
+# Entries are kept compactly: each as a (val, version) tuple, with the
+# key and the value as byte strings (unicode is stored UTF-8 encoded).
+# Keys aren't interned: Python 2's table of interned strings would cost
+# another dict slot per key, more than sharing the string saves. The
+# {"val": ..., "version": ...} dicts callers see are made on the way
+# out. The index is a packed array of positions beside a list of the
+# keys at them, rather than a tuple per key.
+#
+# The index is kept up lazily. New keys are buffered, and merged into the
+# index by the next range query; deleted keys stay in the index until
+# enough of them build up to be worth sweeping out.
+# Callers lock the store themselves, as they did the dict.
+#
+# The store can also list its keys in key order, for scans by key range.
+# That index, a sorted list of the keys, is only built on the first such
+# scan, and after that kept up the same lazy way.
+#
+# A store may also keep a filter of its keys (a bloom.CountingBloom),
+# which it adds keys to and removes them from as they come and go, and
+# rebuilds twice the size whenever the keys outgrow it.
+#
+# With a capacity, in bytes, the store is a cache: evict() drops keys,
+# least recently used first, until the store is within it. Recency is
+# approximate, as in Redis: of EVICTION_SAMPLES keys picked at random,
+# the one used longest ago goes.
+class Store(object):
+    def __init__(self, entries=None, filter=None, capacity=None):
+        self.entries = {}
+        # the index: positions, and the keys at them
+        self.hashes = array.array("I")
+        self.indexed = []
+        # keys not merged into the index yet, as (position, key)
+        self.added = []
+        # deleted keys still in the index
+        self.removed = set()
+        # the keys in key order, once asked for; keys added since, not
+        # merged in yet; and how many keys in it have been deleted
+        self.ordered = None
+        self.ordered_added = []
+        self.ordered_dead = 0
+        self.filter = filter
+        # bytes stored, as counted by entry_size
+        self.size = 0
+        self.capacity = None
+        self.ticks = None
+        self.clock = 0
+        self.evicted = 0
+        self.set_capacity(capacity)
+        if entries is not None:
+            self.update(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return encode(key) in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, key):
+        return unpack(self.entries[encode(key)])
+
+    # Like __getitem__, but counts as a use of the key for eviction
+    def get(self, key, default=None):
+        key = encode(key)
+        packed = self.entries.get(key)
+        if packed is None:
+            return default
+        if self.ticks is not None:
+            self.touch(key)
+        return unpack(packed)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def items(self):
+        return [(key, unpack(packed)) for (key, packed) in self.entries.iteritems()]
+
+    def __setitem__(self, key, entry):
+        key = encode(key)
+        packed = pack(entry)
+        old = self.entries.get(key)
+        if old is None:
+            if key in self.removed:
+                # deleted, but still in the index
+                self.removed.discard(key)
+            else:
+                self.added.append((common.hash_key(key), key))
+            if self.ordered is not None:
+                self.ordered_added.append(key)
+            if self.filter is not None:
+                self.filter.add(key)
+                if len(self.entries) >= self.filter.capacity:
+                    self.filter.rebuild(self.entries.keys() + [key], 2 * self.filter.capacity)
+        else:
+            self.size -= entry_size(key, old)
+        self.entries[key] = packed
+        self.size += entry_size(key, packed)
+        if self.ticks is not None:
+            self.touch(key)
+
+    def pop(self, key, *default):
+        key = encode(key)
+        if key not in self.entries:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.removed.add(key)
+        if self.ordered is not None:
+            self.ordered_dead += 1
+        if self.filter is not None:
+            self.filter.remove(key)
+        if self.ticks is not None:
+            self.ticks.pop(key, None)
+        packed = self.entries.pop(key)
+        self.size -= entry_size(key, packed)
+        return unpack(packed)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def update(self, entries):
+        for (key, entry) in entries.items():
+            self[key] = entry
+
+    def clear(self):
+        self.__init__(filter=self.filter, capacity=self.capacity)
+        if self.filter is not None:
+            self.filter.rebuild([], 0)
+
+    # The ring position of a key
+    def position(self, key):
+        return common.hash_key(key)
+
+    # Keys whose positions fall in [lo, hi), in ring order
+    def arc(self, lo, hi):
+        self.sort()
+        start = bisect.bisect_left(self.hashes, lo)
+        end = bisect.bisect_left(self.hashes, hi, start)
+        entries = self.entries
+        return [key for key in self.indexed[start:end] if key in entries]
+
+    # Keys in any of a list of [lo, hi) arcs
+    def in_arcs(self, arcs):
+        keys = []
+        for (lo, hi) in arcs:
+            keys.extend(self.arc(lo, hi))
+        return keys
+
+    # Up to limit live keys, in ring order, from position start on, as
+    # (position, key) pairs; and the position to go on from, or None at
+    # the end of the ring. Keys that share a position are never split
+    # between pages, so a page may run over limit by the few keys that
+    # share its last position, and they are in key order.
+    def ring_page(self, start, limit):
+        self.sort()
+        hashes = self.hashes
+        first = bisect.bisect_left(hashes, start)
+        end = min(first + max(limit, 1), len(hashes))
+        if end > first:
+            end = bisect.bisect_right(hashes, hashes[end - 1], end)
+        entries = self.entries
+        indexed = self.indexed
+        pairs = sorted((hashes[i], indexed[i]) for i in xrange(first, end) if indexed[i] in entries)
+        if end == len(hashes):
+            return (pairs, None)
+        return (pairs, hashes[end - 1] + 1)
+
+    # Up to limit live keys in key order, from key lo on and before key hi
+    # (None for no bound); and the key to go on from, or None once there
+    # are no more
+    def key_page(self, lo, hi, limit):
+        ordered = self.key_order()
+        i = bisect.bisect_left(ordered, encode(lo or ""))
+        hi = None if hi is None else encode(hi)
+        entries = self.entries
+        keys = []
+        while len(keys) < max(limit, 1):
+            if i == len(ordered) or (hi is not None and ordered[i] >= hi):
+                return (keys, None)
+            key = ordered[i]
+            i += 1
+            # a key deleted and added again is in the list twice
+            if key in entries and (not keys or keys[-1] != key):
+                keys.append(key)
+        # the least key after the last one
+        return (keys, keys[-1] + "\0")
+
+    # The keys in key order, brought up to date
+    def key_order(self):
+        if self.ordered is None or self.ordered_dead * 2 > len(self.ordered):
+            self.ordered = sorted(self.entries)
+            (self.ordered_added, self.ordered_dead) = ([], 0)
+        elif self.ordered_added:
+            added = self.ordered_added
+            self.ordered_added = []
+            added.sort()
+            self.ordered = merge_sorted(self.ordered, added)
+        return self.ordered
+
+    # The live entries in ring order, as parallel lists of positions, keys
+    # and (val, version) entries; what a snapshot saves
+    def dump(self):
+        self.sort()
+        if self.removed:
+            self.sweep()
+        entries = self.entries
+        return (self.hashes.tolist(), list(self.indexed), [entries[key] for key in self.indexed])
+
+    # Replaces the contents with those of a dump(), which is already in
+    # ring order, so nothing is hashed or sorted. Entries may also be
+    # dicts, as snapshots held them before entries were packed.
+    def load(self, positions, keys, entries):
+        self.__init__(filter=self.filter, capacity=self.capacity)
+        keys = [encode(key) for key in keys]
+        if entries and isinstance(entries[0], dict):
+            entries = [pack(entry) for entry in entries]
+        self.entries = dict(zip(keys, entries))
+        self.hashes = array.array("I", positions)
+        self.indexed = keys
+        self.size = sum(entry_size(key, packed) for (key, packed) in self.entries.iteritems())
+        if self.ticks is not None:
+            self.ticks = dict.fromkeys(keys, 0)
+        if self.filter is not None:
+            self.filter.rebuild(keys, 2 * len(keys))
+
+    # Brings the index up to date: sweeps out deleted keys once they are
+    # half of it, and merges in the keys added since the last sort. A few
+    # new keys are spliced in between slices of the index; many are
+    # sorted in along with it.
+    def sort(self):
+        if len(self.removed) * 2 > len(self.indexed):
+            self.sweep()
+        if not self.added:
+            return
+        added = self.added
+        self.added = []
+        added.sort()
+        if len(added) * 8 > len(self.indexed):
+            pairs = zip(self.hashes, self.indexed)
+            pairs.extend(added)
+            pairs.sort()
+            self.hashes = array.array("I", [h for (h, key) in pairs])
+            self.indexed = [key for (h, key) in pairs]
+            return
+        (hashes, indexed) = (self.hashes, self.indexed)
+        merged_hashes = array.array("I")
+        merged = []
+        start = 0
+        for (h, key) in added:
+            end = bisect.bisect_right(hashes, h, start)
+            merged_hashes.extend(hashes[start:end])
+            merged.extend(indexed[start:end])
+            merged_hashes.append(h)
+            merged.append(key)
+            start = end
+        merged_hashes.extend(hashes[start:])
+        merged.extend(indexed[start:])
+        self.hashes = merged_hashes
+        self.indexed = merged
+
+    # Drops the deleted keys from the index
+    def sweep(self):
+        entries = self.entries
+        keep = [i for (i, key) in enumerate(self.indexed) if key in entries]
+        hashes = self.hashes
+        self.hashes = array.array("I", [hashes[i] for i in keep])
+        self.indexed = [self.indexed[i] for i in keep]
+        self.added = [(h, key) for (h, key) in self.added if key in entries]
+        self.removed = set()
+
+    # A capacity of None leaves the store unbounded
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        if capacity is None:
+            self.ticks = None
+        elif self.ticks is None:
+            self.ticks = dict.fromkeys(self.entries, 0)
+
+    def touch(self, key):
+        self.clock += 1
+        self.ticks[key] = self.clock
+
+    # Drops keys until the store is within its capacity, and returns them
+    def evict(self):
+        evicted = []
+        if self.capacity is None:
+            return evicted
+        while self.size > self.capacity and self.entries:
+            self.sort()
+            if len(self.removed) * 4 > len(self.indexed):
+                self.sweep()
+            sample = set()
+            while len(sample) < min(EVICTION_SAMPLES, len(self.entries)):
+                key = random.choice(self.indexed)
+                if key in self.entries:
+                    sample.add(key)
+            victim = min(sample, key=lambda key: self.ticks.get(key, 0))
+            self.pop(victim)
+            evicted.append(victim)
+        self.evicted += len(evicted)
+        return evicted
+
+    # How much the store holds, and how much it may
+    def stats(self):
+        return {"keys": len(self.entries), "bytes": self.size, "capacity": self.capacity,
+            "evicted": self.evicted}
+
+# keys sampled per eviction
+EVICTION_SAMPLES = 5
+
+# What an entry costs besides the bytes of its key and value, roughly:
+# its slot in the entries dict, its tuple, version and string headers,
+# and its place in the index; measured by `python bench.py memory`
+ENTRY_OVERHEAD = 330
+
+def entry_size(key, packed):
+    val = packed[0]
+    return len(key) + (len(val) if isinstance(val, str) else 8) + ENTRY_OVERHEAD
+
+# Merges the sorted list added into the sorted list items: a few items
+# are spliced in between slices of it, many sorted in along with it
+def merge_sorted(items, added):
+    if len(added) * 8 > len(items):
+        return sorted(items + added)
+    merged = []
+    start = 0
+    for item in added:
+        end = bisect.bisect_right(items, item, start)
+        merged.extend(items[start:end])
+        merged.append(item)
+        start = end
+    merged.extend(items[start:])
+    return merged
+
+def encode(s):
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return s
+
+def pack(entry):
+    return (encode(entry["val"]), entry.get("version", 0))
+
+def unpack(packed):
+    return {"val": packed[0], "version": packed[1]}
@@ -1,67 +1,178 @@
 #!/usr/bin/python
 
+import os
+import gc
+import json
 import common
 import common2
+import kvstore
+import bloom
+import wal
 import random
 import argparse
 import time
+import threading
 
 ##############
 # Globals
 
 # Stores global configuration variables
 # NEW VALUES: 
-#   -"new"=used to determine if a rebalance request should be honored
-#   because the server just started.
-#   -"key_lowBound"= points at one's own ID until the view grows larger
-#   than the replication number (3). Then, it points to the server hash
-#   that is (3) positions counterclockwise from this server. See theory in
-#   README.
-#   -"rebalancing"= used to reject client RPCs when rebalancing is taking
-#   place, as well as to determine appropriate action when a "finalize"
-#   RPC is received from the viewleader.
+#   -"arcs"= the [lo, hi) arcs of the hash ring whose keys this server
+#   stores in the current view, as worked out by common.Ring: the whole
+#   ring until the view grows larger than the replication number. See
+#   theory in README.
+#   -"view"= the server IDs of the view those arcs belong to; None until
+#   the server's first rebalance, as it just started.
+#   -"next"= the view, arcs and lost arcs of a rebalance in progress,
+#   which take effect at "finalize".
+#   -"stale"= set when the server restarts from disk after the view went
+#   on without it: the keys it has on its arcs may have missed writes,
+#   so its next rebalance fetches all of its arcs again.
+#   -"rebalancing"= set from a rebalance until its "finalize" or
+#   "revert". Meanwhile the server goes on serving reads and writes,
+#   except for writes to the keys it is about to hand over.
+#   -"snapshotting"= set while a snapshot of the store is being written.
+#   -"publish_bloom"= whether heartbeats carry the store's Bloom filter.
 ID=common.hash_key(str(random.random()))
 config = {"epoch": None,
-          "new": True,
           "port": None,
           "server_hash": ID,
           "last_heartbeat": None,
-          "key_lowBound": ID,
+          "publish_bloom": common2.BLOOM_PUBLISH,
+          "bloom_published": None,
+          "arcs": [],
+          "view": None,
+          "next": None,
+          "stale": False,
+          "snapshotting": False,
           "rebalancing": False}
 
-print ("Server Hash ID: {}".format(config["server_hash"]))
+# Stores shared values for get and set commands, indexed by ring position.
+# Each entry is {"val": value, "version": version}; see common.new_version.
+# A Bloom filter of its keys goes to the viewleader with the heartbeats,
+# for clients to skip the replicas that don't have a key.
+store = kvstore.Store(filter=bloom.CountingBloom())
 
-# Stores shared values for get and set commands
-store = {}
 
-
-# Stores 'setr' keys/values, until server receives commit or cancel
+# Stores 'setr' keys/values, until server receives commit or cancel:
+# pending[key] maps the ID of each transaction that prepared the key to
+# the entry it would write, so prepares from different transactions queue
+# up side by side. A prepare that is neither committed nor canceled
+# within PENDING_TTL seconds was abandoned by its coordinator, and is
+# dropped.
 pending = {}
+PENDING_TTL = 30
+
+# Requests are handled concurrently, so every access to config, store
+# and pending holds this lock. It is never held across an RPC.
+state_lock = threading.RLock()
+
+# With a data directory (--data-dir), the write-ahead log of the store;
+# see wal.py. Otherwise None, and the store lives only in memory.
+data_dir = None
+journal = None
+
+# Logs updates to the store, each a ("set", key, entry) or ("del", key)
+# record. Callers hold state_lock, so that records are logged in the same
+# order as the updates, and call log_sync() before replying.
+def log_records(records):
+    if journal is not None:
+        journal.append(records)
+
+# Waits until everything logged so far is on disk. Writes from many
+# requests share one fsync; see wal.Log.
+def log_sync():
+    if journal is not None:
+        journal.sync()
 
 # Request or extend a lease from view leaer
 def update_lease():
     if config["port"] is None:
         return {}
     config["last_heartbeat"] = time.time()
+    msg = {
+        "cmd": "heartbeat",
+        "port": config["port"],
+        "requestor": config["server_hash"],
+    }
+    # the store's filter, if it is published and changed since the
+    # viewleader last had it
+    with state_lock:
+        if config["publish_bloom"] and store.filter.version != config["bloom_published"]:
+            msg["bloom"] = store.filter.snapshot()
+            msg["bloom"]["version"] = store.filter.version
     res = common.send_receive_range(config["viewleader"], common2.VIEWLEADER_LOW , 
-        common2.VIEWLEADER_HIGH , {
-            "cmd": "heartbeat",
-            "port": config["port"],
-            "requestor": config["server_hash"],
-        })
+        common2.VIEWLEADER_HIGH , msg)
     if "error" in res:
         print "Can't update lease: %s" % res["error"]
         return res
+    if res.get("status") == "deny" and data_dir is not None:
+        # the ID was restored from disk, and its lease expired while the
+        # server was down; come back under a new one
+        with state_lock:
+            config["server_hash"] = common.hash_key(str(random.random()))
+            config["stale"] = True
+        save_state()
+        print "Lease denied, new Server Hash ID: %s" % config["server_hash"]
+        return update_lease()
     if res.get("status") == 'ok':
-        if config["epoch"] is not None and res["epoch"] < config["epoch"]:
-            print "Received invalid epoch (%s < %s)" % (res["epoch"], config["epoch"])
-            return {"error": "bad epoch"}
-        else:
-            config["epoch"] = res["epoch"]
+        # the view subscription may have brought a newer epoch already
+        adopt_epoch(res["epoch"])
+        # the version of the filter the viewleader holds
+        config["bloom_published"] = res.get("bloom")
     else:
         print "Can't renew lease: %s" % res["status"]
         return res
-    return {}
+    return {"lease": res.get("lease", common2.LOCK_LEASE)}
+
+# Heartbeats are sent from their own thread, so no request ever waits on
+# the viewleader. The lease is renewed HEARTBEATS_PER_LEASE times per
+# lease length (which the viewleader sends with each renewal), so a slow
+# or lost heartbeat or two doesn't cost the server its lease; if the
+# viewleader can't be reached, the next try comes HEARTBEAT_RETRY seconds
+# later instead of a whole interval.
+HEARTBEATS_PER_LEASE = 3
+HEARTBEAT_RETRY = 1
+
+def heartbeat_loop():
+    interval = float(common2.LOCK_LEASE) / HEARTBEATS_PER_LEASE
+    while True:
+        start = time.time()
+        try:
+            res = update_lease()
+        except Exception as e:
+            res = {"error": "%s" % e}
+        expire_pending()
+        if "error" in res:
+            wait = HEARTBEAT_RETRY
+        else:
+            if "lease" in res:
+                interval = float(res["lease"]) / HEARTBEATS_PER_LEASE
+            wait = interval
+        time.sleep(max(0, wait - (time.time() - start)))
+
+# The server also subscribes to the viewleader's view (see
+# common.follow_view). It learns of a new epoch as soon as the viewleader
+# has one, rather than at its next heartbeat, so it turns away clients
+# with an outdated view sooner. The view itself is kept for the commit
+# coordinator and repair, which then needn't ask for it.
+def view_follower():
+    common.follow_view(config["viewleader"], follow_view)
+
+def follow_view(view, change):
+    adopt_epoch(view["epoch"])
+    coordinator["view"]=common.parse_view(view) if view["result"] else None
+
+# Takes up an epoch the viewleader sent. Within one generation it only
+# moves forward, as replies may arrive out of order; a new generation,
+# from a viewleader that restarted, is taken whatever its value.
+def adopt_epoch(epoch):
+    with state_lock:
+        current = config["epoch"]
+        if current is None or epoch > current or \
+                common.epoch_generation(epoch) != common.epoch_generation(current):
+            config["epoch"] = epoch
 
 ###################
 # RPC implementations
@@ -69,72 +180,248 @@ def update_lease():
 # Init function - nop
 def init(msg, addr):
     config["port"] = msg["port"]
-    update_lease()
+    heartbeat = threading.Thread(target=heartbeat_loop)
+    heartbeat.daemon = True
+    heartbeat.start()
+    follower = threading.Thread(target=view_follower)
+    follower.daemon = True
+    follower.start()
+    repairer = threading.Thread(target=repair_loop)
+    repairer.daemon = True
+    repairer.start()
     return {}
 
 # set command sets a key in the value store
 def set_val(msg, addr):
     key = msg["key"]
     val = msg["val"]
-    store[key] = {"val": val}
+    with state_lock:
+        put_entry(key, {"val": val, "version": common.new_version()})
+    log_sync()
     print "Setting key %s to %s in local store" % (key, val)
     return {"status": "ok"}
 
 # setr returns a yes or no vote to the client, depending on
 # rebalancing status and other pending set requests
 def setr_val(msg,addr):
-    if config["rebalancing"]:
+    with state_lock:
+        vote=prepare_key(msg["key"], msg["val"], msg.get("txid"))
+        epoch=config["epoch"]
+    if vote=="no":
         return {"vote": "no"}
-    key=msg["key"]
-    val=msg["val"]
-    if key in pending:
-        return{"vote":"no"}
-    else:
-        pending[key]={"val":val}
-        print "Awaiting commit"
-        return{"vote":"yes", "epoch": config["epoch"]}
+    print "Awaiting commit"
+    return{"vote":"yes", "epoch": epoch}
         
 # commit moves a pending key-value pair into the main store
 # if the key in question is in pending. Returns a status message.
 def commit(msg,addr):
-    key=msg["key"]
-    if key in pending:
-        store[key]=pending[key]
-        del(pending[key])
+    with state_lock:
+        res=commit_key(msg["key"], msg.get("txid"))
+    log_sync()
+    if res["status"]=="ok":
         print "Commit received"
-        return{"status": "ok"}
     else:
         print "Setr failed"
-        return{"status": "invalid commit"}
+    return res
 # cancel removes a key from the pending store,
 # without transfering it to the main store.
 def cancel(msg,addr):
-    key=msg["key"]
-    if key in pending:
-        del(pending[key])
+    with state_lock:
+        res=cancel_key(msg["key"], msg.get("txid"))
+    if res["status"]=="setr canceled":
         print "Replicated set canceled"
-        return {"status":"setr canceled"}
-    else:
-        return {"status":"invalid cancel"}
+    return res
 
 # fetches a key in the value store
 def get_val(msg, addr):
-    if config["rebalancing"]:
-        return {"status": "rebalancing: retry"}
     key = msg["key"]
-    if key in store:
+    with state_lock:
+        res = get_key(key)
+    if res["status"]=="ok":
         print "Querying stored value of %s" % key
-        return {"status": "ok", "value": store[key]["val"],}
-    else:
+    elif res["status"]=="not_found":
         print "Stored value of key %s not found" % key
+    return res
+
+# The per-key steps of the RPCs above, shared with their batch forms
+# below. Callers hold state_lock.
+#
+# A transaction's ID is the version of what it writes. Requests without
+# one come from clients that predate transaction IDs: they get a version
+# from this server's clock, and as before only one of them may have a key
+# prepared at a time.
+def prepare_key(key, val, txid):
+    if config["rebalancing"] and leaving(key):
+        return "no"
+    txns=pending.setdefault(key, {})
+    if txid is None and None in txns:
+        return "no"
+    version=txid if txid is not None else common.new_version()
+    txns[txid]={"val": val, "version": version, "expires": time.time()+PENDING_TTL}
+    return "yes"
+
+def commit_key(key, txid):
+    txns=pending.get(key, {})
+    if txid not in txns:
+        return {"status": "invalid commit"}
+    entry=txns.pop(txid)
+    if not txns:
+        del pending[key]
+    put_entry(key, {"val": entry["val"], "version": entry["version"]})
+    return {"status": "ok"}
+
+def cancel_key(key, txid):
+    txns=pending.get(key, {})
+    if txns.pop(txid, None) is None:
+        return {"status":"invalid cancel"}
+    if not txns:
+        del pending[key]
+    return {"status":"setr canceled"}
+
+# Stores an entry unless the key already has a newer version, so that
+# replicas end up with the same value whatever order writes reach them in
+def put_entry(key, entry):
+    if newer(store.get(key), entry):
+        return
+    store[key]=entry
+    log_records([("set", key, entry)])
+    evicted=store.evict()
+    if evicted:
+        log_records([("del", k) for k in evicted])
+
+# Whether entry a is newer than entry b; entries from before versions
+# count as oldest
+def newer(a, b):
+    return a is not None and a.get("version", 0) > b.get("version", 0)
+
+# Drops the prepares whose coordinators never came back to them
+def expire_pending():
+    now=time.time()
+    with state_lock:
+        for key in pending.keys():
+            txns=pending[key]
+            for txid in [t for t in txns if txns[t]["expires"]<now]:
+                del txns[txid]
+            if not txns:
+                del pending[key]
+
+def get_key(key):
+    entry = store.get(key)
+    if entry is None:
         return {"status": "not_found"}
+    return {"status": "ok", "value": entry["val"], "version": entry.get("version", 0)}
+
+# Batch RPCs carry many keys in one message: "items" maps keys to values
+# for mset and msetr, "keys" lists keys for the others. Each key gets its
+# own result, keyed the same way.
+def mset(msg, addr):
+    items=msg["items"]
+    version=common.new_version()
+    with state_lock:
+        for key in items:
+            put_entry(key, {"val": items[key], "version": version})
+    log_sync()
+    print "Setting %s keys in local store" % len(items)
+    return {"results": dict((key, {"status": "ok"}) for key in items)}
 
+# msetr votes on each key separately; the epoch applies to all the votes
+def msetr(msg, addr):
+    items=msg["items"]
+    with state_lock:
+        votes=dict((key, prepare_key(key, items[key], msg.get("txid"))) for key in items)
+        epoch=config["epoch"]
+    print "Awaiting commit of %s keys" % votes.values().count("yes")
+    return {"votes": votes, "epoch": epoch}
 
-# Returns all keys in the value store
+def mcommit(msg, addr):
+    with state_lock:
+        results=dict((key, commit_key(key, msg.get("txid"))) for key in msg["keys"])
+    log_sync()
+    print "Commit received for %s keys" % len(results)
+    return {"results": results}
+
+def mcancel(msg, addr):
+    with state_lock:
+        results=dict((key, cancel_key(key, msg.get("txid"))) for key in msg["keys"])
+    print "Replicated set canceled for %s keys" % len(results)
+    return {"results": results}
+
+def mget(msg, addr):
+    with state_lock:
+        results=dict((key, get_key(key)) for key in msg["keys"])
+    print "Querying stored values of %s keys" % len(results)
+    return {"results": results}
+
+
+# Returns all keys in the value store, streamed in batches
 def query_all_keys(msg, addr):
     print "Returning all keys"
-    keyvers = [ key for key in store.keys() ]
-    return {"result": keyvers}
+    with state_lock:
+        keyvers = [ key for key in store.keys() ]
+    return common.Stream({"result": batch}
+        for batch in batches(keyvers, STREAM_BATCH))
+
+# Keys per part of a streamed reply
+STREAM_BATCH = 500
+
+# A page of the store's keys, for enumerating a store a bounded piece at a
+# time. Pages follow ring order, or key order with "order": "key". Each
+# reply has a "cursor", to send back for the next page, which is null
+# after the last page. A page covers at most "limit" keys of the store
+# (SCAN_PAGE by default, SCAN_PAGE_MAX at most). Only those that match
+# the "prefix" and the ["start", "end") key range, if given, are
+# returned, so a selective scan may get pages with few or no keys in
+# them before it is done. In key order the prefix and range bound the
+# part of the store read, and in ring order they only filter it. With
+# "values", the entries of the keys come too.
+def scan(msg, addr):
+    limit=min(msg.get("limit") or SCAN_PAGE, SCAN_PAGE_MAX)
+    prefix=kvstore.encode(msg.get("prefix") or "")
+    start=kvstore.encode(msg.get("start") or "")
+    end=msg.get("end")
+    end=None if end is None else kvstore.encode(end)
+    cursor=msg.get("cursor")
+    with state_lock:
+        if msg.get("order")=="key":
+            lo=max(kvstore.encode(cursor or ""), start, prefix)
+            (keys, cursor)=store.key_page(lo, min_bound(end, prefix_end(prefix)), limit)
+        else:
+            (pairs, cursor)=store.ring_page(cursor or 0, limit)
+            keys=[key for (h, key) in pairs]
+        keys=[key for key in keys if key.startswith(prefix) and key>=start and
+            (end is None or key<end)]
+        res={"keys": keys, "cursor": cursor}
+        if msg.get("values"):
+            res["entries"]=[store[key] for key in keys]
+    return res
+
+# keys per scan page
+SCAN_PAGE = 500
+SCAN_PAGE_MAX = 5000
+
+# The least key after every key with prefix, or None if there is none
+def prefix_end(prefix):
+    prefix=prefix.rstrip("\xff")
+    if not prefix:
+        return None
+    return prefix[:-1]+chr(ord(prefix[-1])+1)
+
+def min_bound(a, b):
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a, b)
+
+# Splits a list into lists of at most n items; always yields at least one,
+# so that a streamed reply has a part to send even when there's no data.
+def batches(items, n):
+    for i in range(0, max(len(items), 1), n):
+        yield items[i:i+n]
+
+# How many keys and bytes the store holds, its capacity and how many keys
+# it has evicted
+def store_stats(msg, addr):
+    with state_lock:
+        return store.stats()
 
 # Print a message in response to print command
 def print_something(msg, addr):
@@ -143,99 +430,484 @@ def print_something(msg, addr):
 
 # accept timed out - nop
 def tick(msg, addr):
+    expire_pending()
     #print "Store state:", sorted(store) #TESTING
     return {}
 
+##############
+# Coordinated setr
+# A client may hand a replicated set to any server with "csetr", rather
+# than running the two-phase commit itself. The server groups the csetr
+# requests that arrive in the COMMIT_WINDOW seconds after the first, and
+# any that arrive while a round is in flight, and commits each group as
+# one transaction (common.replicated_set): a single prepare and commit per
+# replica, however many keys and clients the group holds. A key set more
+# than once in a group gets the value that arrived last.
+COMMIT_WINDOW = 0.002
+
+# csetr requests waiting for the next round, as (key, value, future)
+queued = []
+# guards queued and coordinator["running"]; rounds run one at a time
+queue_lock = threading.Lock()
+coordinator = {"running": False, "view": None}
+
+def csetr(msg, addr):
+    future=common.Future()
+    with queue_lock:
+        queued.append((msg["key"], msg["val"], future))
+        start=not coordinator["running"]
+        coordinator["running"]=True
+    if start:
+        common.spawn(commit_rounds)
+    return future
+
+# Runs rounds until no requests are left waiting
+def commit_rounds():
+    time.sleep(COMMIT_WINDOW)
+    while True:
+        with queue_lock:
+            group=list(queued)
+            del queued[:]
+            if not group:
+                coordinator["running"]=False
+                return
+        try:
+            results=commit_round(group)
+        except Exception as e:
+            results=dict((key, "failed: coordinator error %s" % e) for (key, val, future) in group)
+        for (key, val, future) in group:
+            future.set_result({"status": results[key]})
+        print "Committed a group of %s replicated sets" % len(group)
+
+def commit_round(group):
+    items=dict((key, val) for (key, val, future) in group)
+    view=current_view(False)
+    if view is None:
+        return dict((key, "failed: no view") for key in items)
+    outcome=common.replicated_set(items, *view)
+    results=outcome["results"]
+    if outcome["outdated"]:
+        view=current_view(True)
+        if view is not None:
+            retry=dict((key, items[key]) for key in outcome["outdated"])
+            results.update(common.replicated_set(retry, *view)["results"])
+    return results
+
+# The view the coordinator commits with, and repair works from, asked of
+# the viewleader again once the server's epoch has moved past it, or if
+# refresh is set
+def current_view(refresh):
+    with state_lock:
+        epoch=config["epoch"]
+    view=coordinator["view"]
+    if refresh or view is None or (epoch is not None and view[2]<epoch):
+        res=common.send_receive_range(config["viewleader"], common2.VIEWLEADER_LOW,
+            common2.VIEWLEADER_HIGH, {"cmd": "query_servers"})
+        if "error" in res or not res["result"]:
+            return None
+        view=common.parse_view(res)
+        coordinator["view"]=view
+    return view
+
+##############
+# Repair
+# With a write quorum below the replication number, a write may commit
+# without some of its replicas. They catch up two ways. A client that
+# reads from several replicas sends the newest value it saw to those
+# that had an older one ("repair"). And every REPAIR_INTERVAL seconds
+# each server compares the versions of the keys it shares with each of
+# its ring neighbours ("versions"), and sends them whatever it has a
+# newer version of. As every server does this, replicas converge.
+# A server whose store has a capacity (--capacity) is a cache, which
+# evicts keys on its own, so it doesn't take part.
+REPAIR_INTERVAL = 30
+
+# Stores the entries of msg["items"] that are newer than the ones here
+def repair(msg, addr):
+    items=msg["items"]
+    with state_lock:
+        for key in items:
+            put_entry(key, items[key])
+    log_sync()
+    return {"status": "ok"}
+
+# The versions of the keys this server has on the arcs msg["arcs"],
+# streamed in batches
+def versions(msg, addr):
+    with state_lock:
+        keys=store.in_arcs(msg["arcs"])
+    return common.Stream(version_parts(keys))
+
+def version_parts(keys):
+    for batch in batches(keys, STREAM_BATCH):
+        with state_lock:
+            found=dict((k, store[k].get("version", 0)) for k in batch if k in store)
+        yield {"versions": found}
+
+# One round of background repair against every ring neighbour
+def repair_round():
+    view=current_view(False)
+    if view is None:
+        return
+    (server_ids, serverdata, epoch)=view
+    sid=config["server_hash"]
+    with state_lock:
+        if store.capacity is not None:
+            return
+        if config["rebalancing"] or sorted(config["view"] or [])!=sorted(server_ids):
+            # the store doesn't match this view yet
+            return
+    ring=common.ring_for(server_ids)
+    # the arcs each neighbour shares with this server, from the segments
+    # of this server's own arcs
+    neighbours={}
+    for (lo, hi) in ring.arcs(sid):
+        for (piece, replicas) in ring.segments(lo, hi):
+            for peer in replicas:
+                if peer!=sid:
+                    neighbours.setdefault(peer, []).append(piece)
+    for peer in server_ids:
+        if peer not in neighbours:
+            continue
+        shared=common.merge_arcs(neighbours[peer])
+        theirs=common.send_receive(serverdata[peer]["host"], serverdata[peer]["port"],
+            {"cmd": "versions", "arcs": shared})
+        if "error" in theirs:
+            continue
+        theirs=theirs["versions"]
+        with state_lock:
+            newer_here=dict((k, store[k]) for k in store.in_arcs(shared)
+                if store[k].get("version", 0)>theirs.get(k, -1))
+        if newer_here:
+            common.send_receive(serverdata[peer]["host"], serverdata[peer]["port"],
+                {"cmd": "repair", "items": newer_here})
+            print "Repaired %s keys on %s" % (len(newer_here), peer)
+
+def repair_loop():
+    while True:
+        time.sleep(REPAIR_INTERVAL)
+        try:
+            repair_round()
+        except Exception as e:
+            print "Repair failed: %s" % e
+
 ##############
 # Rebalance Functions
-# Temporary store for data received from other servers
-# after a "share" request. Merged into main store and 
-# deleted after receiving "finalize" rpc from viewleader.
-storeNew={}
+# A rebalance doesn't take the server out of service. The store stays the
+# current one throughout, and the next one is made from it in place: the
+# keys fetched on the gained arcs are merged into it as they arrive,
+# keeping whichever version is newer, so reads and writes carry on
+# against it meanwhile; at finalize the keys on the lost arcs are dropped
+# and the new arcs take effect, under state_lock, so readers see either
+# the old arcs or the new ones. Nothing the two have in common is copied.
+# Only writes to keys on the lost arcs are refused until then, as the
+# servers taking them over may already have fetched them. A rebalance
+# that is reverted, or replaced by another before it finalizes, takes its
+# fetched keys with it (see abandon_next): nothing else would ever drop
+# them, as the arcs they are on were never the server's.
 
 # 'rebalance' is an rpc received from the viewleader after 
-# every epoch change. Based on the new view, the function determines 
-# whether or not the server's store may need to be modified.
-# If not, it responds to the viewleader "ok".
-# If so, it sends a "share" rpc to all servers in the new
-# view, except itself, storing appropriate responses in storeNew.
-# When finished, it sends a "done" status to the viewleader.
+# every epoch change. Based on the new view, the function works out which
+# arcs of the ring the server gains and which it loses. If it loses none
+# and no other server has any of the gained ones, it
+# responds to the viewleader "ok".
+# Otherwise, it asks one server that holds each piece of its gained arcs,
+# in the old view or the new one, for just that piece (see share_plan),
+# merging their responses into the store. When finished, it sends a
+# "done" status to the viewleader.
 def rebalance(msg, addr):
-    global storeNew
-    config["epoch"]=msg["epoch"]
-    if len(msg["view"])<2:
-        config["new"]=False
+    view=msg["view"]
+    sid=config["server_hash"]
+    with state_lock:
+        adopt_epoch(msg["epoch"])
+        # a new server has no data and no view of its own to compare
+        # with; it takes the viewleader's last finalized one, if any
+        old_view=config["view"]
+        if old_view is None:
+            old_view=msg.get("old_view")
+        arcs=config["arcs"]
+        fresh=[] if config["stale"] else arcs
+    # the rings are worked through without the lock, so that requests
+    # go on meanwhile; only the viewleader changes the arcs, and it runs
+    # one rebalance at a time
+    ring=common.ring_for(view)
+    old_ring=None
+    if old_view is not None:
+        old_ring=common.ring_for(old_view)
+    new_arcs=ring.arcs(sid)
+    gained=common.subtract_arcs(new_arcs, fresh)
+    lost=common.subtract_arcs(arcs, new_arcs)
+    fetches=share_plan(sid, gained, view, ring, old_ring)
+    with state_lock:
+        needed=bool(fetches or lost)
+        abandon_next()
+        if needed:
+            plan=config["next"]=(view, new_arcs, lost)
+            config["rebalancing"]=True
+        else:
+            config["view"]=view
+            config["arcs"]=new_arcs
+            config["stale"]=False
+    if not needed:
+        log_sync()
+        save_state()
         return {"status": "ok"}
-    new_lowBound=common.lowBound(config["server_hash"],msg["view"])
-    if type(new_lowBound)==tuple:
-        (new_lowBound, discard)=new_lowBound
-    if config["key_lowBound"]!=new_lowBound or config["new"]:
-        config["key_lowBound"]=new_lowBound
-        config["new"]=False
-        config["rebalancing"]=True
-        d=msg["serverdata"]
-        serverdata={int(k):v for k,v in d.items()}
-        all_sids=msg["view"]
-        sids=filter(lambda x : x!=config["server_hash"], msg["view"])
-        #don't ask yourself for data
-        msg={"cmd": "share", "requestor":config["server_hash"],
-        "view":all_sids}
-        new_data=common.broadcast_receive(sids,serverdata,msg)
-        for item in new_data:
-            if "error" in item: 
-                print "Share request denied"
-            else:
-                storeNew.update(item["store"])
-        return {"status":"done"}
-    else:
-        config["new"]=False
-        return {"status":"ok"}
+    d=msg["serverdata"]
+    serverdata={int(k):v for k,v in d.items()}
+    # each part of a share reply is merged into the store as it arrives,
+    # a batch at a time, so that neither the reply nor the lock is held
+    # for long; once the rebalance is reverted or replaced, the rest of
+    # the reply is thrown away
+    fetched=[0]
+    def receive(part):
+        items=part.get("store", {})
+        with state_lock:
+            if config["next"] is not plan:
+                return
+            for key in items:
+                put_entry(key, items[key])
+            fetched[0]+=len(items)
+    # each piece is fetched from one server; the pieces asked of one that
+    # fails go to their next candidate. Without the old view every
+    # candidate is asked at once instead.
+    every=old_ring is None
+    while fetches:
+        requests=share_requests(sid, fetches, every)
+        replies=dict((peer, common.spawn(common.send_receive, serverdata[peer]["host"],
+            serverdata[peer]["port"], requests[peer], common.REQUEST_TIMEOUT, receive))
+            for peer in requests)
+        failed=set()
+        for peer in requests:
+            if "error" in replies[peer].result():
+                print "Share request to %s denied" % peer
+                failed.add(peer)
+        with state_lock:
+            if every or config["next"] is not plan:
+                break
+        fetches=[(arc, candidates[1:]) for (arc, candidates) in fetches
+            if candidates[0] in failed and len(candidates)>1]
+    log_sync()
+    return {"status":"done", "keys": fetched[0]}
+
+# Whether a key is on the arcs a rebalance in progress hands over
+# (caller holds the lock)
+def leaving(key):
+    (view, arcs, lost)=config["next"]
+    h=store.position(key) if key in store else common.hash_key(key)
+    for (lo, hi) in lost:
+        if lo<=h<hi:
+            return True
+    return False
+
+# How to fetch a server's gained arcs: the pieces of them that lie in one
+# segment of both the new ring and the old, each with the servers to ask
+# for it, in order: those that stored it before the view changed, then
+# those that store it after. Only the segments of the gained arcs are
+# looked at, not the whole view, and only servers still in the view are
+# asked. Without the old view (old_ring None) there is no telling who
+# stored what before, so every other server is a candidate.
+def share_plan(sid, gained, view, ring, old_ring):
+    members=set(view)
+    members.discard(sid)
+    fetches=[]
+    for (lo, hi) in gained:
+        if old_ring is None:
+            fetches.append(([lo, hi], [peer for peer in view if peer in members]))
+            continue
+        for (piece, replicas) in ring.segments(lo, hi):
+            for (arc, held) in old_ring.segments(*piece):
+                candidates=[peer for peer in held if peer in members]
+                candidates+=[peer for peer in replicas
+                    if peer in members and peer not in candidates]
+                if candidates:
+                    fetches.append((arc, candidates))
+    return fetches
+
+# The share requests for a plan: each piece is asked of its first
+# candidate only, or with every, of all of them
+def share_requests(sid, fetches, every=False):
+    arcs={}
+    for (arc, candidates) in fetches:
+        for peer in (candidates if every else candidates[:1]):
+            arcs.setdefault(peer, []).append(arc)
+    return dict((peer, {"cmd": "share", "requestor": sid, "arcs": common.merge_arcs(arcs[peer])})
+        for peer in arcs)
 
 # If the server is in a config["rebalancing"] state.
-#'finalize' merges storeNew with the main store, then 
-# clears storeNew, ends the rebalancing state,
-# and sends an "updated" message.
+#'finalize' drops the keys on the arcs the server lost, adopts the new
+# view and arcs, ends the rebalancing state, and sends an "updated"
+# message.
 # Otherwise, it sends an "ok" message to the viewleader. 
 def finalize(msg, addr):
-    global store
-    global storeNew
-    if config["rebalancing"]:
-        print "Old: ",store
-        print "New: ",storeNew
-        store.clear()
-        store.update(storeNew)
-        storeNew.clear()
+    with state_lock:
+        if not config["rebalancing"]:
+            return {"status":"ok"}
+        (view, arcs, lost)=config["next"]
+        dropped=store.in_arcs(lost)
+        for key in dropped:
+            store.pop(key)
+        log_records([("del", key) for key in dropped])
+        print "Dropped %s keys" % len(dropped)
+        res={"status":"updated", "dropped": len(dropped)}
+        config["view"]=view
+        config["arcs"]=arcs
+        config["next"]=None
+        config["stale"]=False
         config["rebalancing"]=False
-        return {"status":"updated"}
-    else: 
-        return {"status":"ok"}
+    log_sync()
+    save_state()
+    return res
 
 # the opposite of finalize. Cancels the rebalance, hopefully until 
 # the view updates and stabilizes and a new rebalance request goes out.
+# The server keeps the view and arcs it had, so the next rebalance
+# compares against those.
 def revert(msg, addr):
-    global storeNew
-    if config["rebalancing"]:
-        storeNew.clear()
-        config["rebalancing"]=False
-        return{"status":"reverted"}
-    else:
-        return {"status": "ok"}
+    with state_lock:
+        if not config["rebalancing"]:
+            return {"status": "ok"}
+        abandon_next()
+    log_sync()
+    return{"status":"reverted"}
+
+# Ends the rebalance in progress, if any, without taking up its arcs:
+# the keys it fetched onto arcs the server doesn't have are dropped.
+# (caller holds the lock)
+def abandon_next():
+    if config["next"] is None:
+        return
+    (view, arcs, lost)=config["next"]
+    dropped=store.in_arcs(common.subtract_arcs(arcs, config["arcs"]))
+    for key in dropped:
+        store.pop(key)
+    log_records([("del", key) for key in dropped])
+    if dropped:
+        print "Abandoned rebalance, dropped %s fetched keys" % len(dropped)
+    config["next"]=None
+    config["rebalancing"]=False
 
 # server to server RPC, used to send relevant data to rebalancing
-# nodes.
+# nodes: the keys on the ring arcs the requestor asks for, or if it
+# names none, those it stores in the given view. They are read off the
+# store's index without rehashing anything.
 def share(msg, addr):
-    sid=msg["requestor"]
-    sids=msg["view"]
-    is_relevant=common.coverageFn(sid,sids)
-    relevants={}
-    for k in store.keys():
-        if is_relevant(common.hash_key(k)):
-            relevants[k]=store[k]
-    return {"store":relevants}
+    arcs=msg.get("arcs")
+    if arcs is None:
+        arcs=common.ring_for(msg["view"]).arcs(msg["requestor"])
+    with state_lock:
+        keys=store.in_arcs(arcs)
+    return common.Stream(share_parts(keys))
+
+# Generates the parts of a share reply, looking up a batch of keys at a
+# time so the store isn't held locked for the whole reply.
+def share_parts(keys):
+    for batch in batches(keys, STREAM_BATCH):
+        relevants={}
+        with state_lock:
+            for k in batch:
+                if k in store:
+                    relevants[k]=store[k]
+        yield {"store":relevants}
+
+##############
+# Durability
+# With a data directory, besides the log and snapshots of the store (see
+# wal.py), the server keeps its ID and the view and arcs it last
+# finalized in a small "state" file. A restarted server comes back with
+# them and its store. If it kept its lease, no replicated write to its
+# keys could commit while it was down, and there is nothing to fetch;
+# otherwise it comes back "stale" and fetches all of its arcs, still
+# only from its ring neighbours.
+
+# Log records before a new snapshot is taken
+SNAPSHOT_RECORDS = 100000
+
+def state_path():
+    return os.path.join(data_dir, "state")
+
+def save_state():
+    if data_dir is None:
+        return
+    with state_lock:
+        state={"id": config["server_hash"], "view": config["view"],
+            "arcs": config["arcs"], "stale": config["stale"]}
+    wal.write_file(state_path(), json.dumps(state))
+
+# Applies a log record to the store
+def replay(record):
+    if record[0]=="set":
+        store[record[1]]=record[2]
+    else:
+        store.pop(record[1], None)
+
+# Loads the state, the latest snapshot and the log after it from the data
+# directory, and opens a new log segment for writes from now on
+def recover(path):
+    global data_dir, journal
+    data_dir=path
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    if os.path.exists(state_path()):
+        with open(state_path()) as f:
+            state=json.load(f)
+        config["server_hash"]=state["id"]
+        config["view"]=state["view"]
+        config["arcs"]=state["arcs"]
+        config["stale"]=state["stale"]
+    start=time.time()
+    # loading creates millions of objects and no garbage; the collector
+    # would only slow it down
+    gc.disable()
+    try:
+        (first, dump)=wal.read_snapshot(data_dir)
+        if dump is not None:
+            store.load(*dump)
+        found=wal.segments(data_dir)
+        for segment in found:
+            if segment>=first:
+                for record in wal.read_records(wal.segment_path(data_dir, segment)):
+                    replay(record)
+    finally:
+        gc.enable()
+    journal=wal.Log(data_dir, max(found+[first])+1)
+    save_state()
+    print "Recovered %s keys from %s in %.2fs" % (len(store), data_dir, time.time()-start)
+
+# Takes a snapshot once enough has been logged since the last one. The
+# store is copied under the lock, at the same moment the log moves to a
+# new segment; the snapshot is written out after the lock is let go.
+def maybe_snapshot():
+    with state_lock:
+        if journal is None or journal.records<SNAPSHOT_RECORDS or config["snapshotting"]:
+            return
+        config["snapshotting"]=True
+        segment=journal.rotate()
+        dump=store.dump()
+    try:
+        wal.write_snapshot(data_dir, segment, dump)
+        print "Snapshot of %s keys taken" % len(dump[1])
+    finally:
+        with state_lock:
+            config["snapshotting"]=False
 
 ##############
 # Main program
 
+# Replicated operations carry the epoch of the client's view of the
+# servers. One older than the server's own epoch may have picked the
+# wrong replicas, so it is turned away with the current epoch, and the
+# client refreshes its view and tries again.
+EPOCH_CHECKED = ("setr", "getr", "msetr")
+
+def stale_epoch(msg):
+    if msg["cmd"] not in EPOCH_CHECKED or msg.get("epoch") is None:
+        return None
+    with state_lock:
+        epoch = config["epoch"]
+    if epoch is not None and msg["epoch"] < epoch:
+        return {"status": "stale_epoch", "epoch": epoch}
+    return None
+
 # RPC dispatcher invokes appropriate function
 def handler(msg, addr):
     #print msg #TESTING
@@ -243,6 +915,7 @@ def handler(msg, addr):
         "init": init,
         "set": set_val,
         "setr": setr_val,
+        "csetr": csetr,
         "get": get_val,
         "getr": get_val,
         "print": print_something,
@@ -250,16 +923,22 @@ def handler(msg, addr):
         "timeout": tick,
         "cancel": cancel,
         "commit": commit,
+        "mset": mset,
+        "mget": mget,
+        "msetr": msetr,
+        "mcommit": mcommit,
+        "mcancel": mcancel,
         "rebalance": rebalance,
         "finalize": finalize,
         "revert": revert,
-        "share": share
+        "share": share,
+        "repair": repair,
+        "versions": versions,
+        "store_stats": store_stats,
+        "scan": scan
     }
-    res =  cmds[msg["cmd"]](msg, addr)
-
-    # Conditionally send heartbeat
-    if time.time() - config["last_heartbeat"] >= 10:
-        update_lease()
+    res = stale_epoch(msg) or cmds[msg["cmd"]](msg, addr)
+    maybe_snapshot()
 
     return res
 
@@ -267,12 +946,29 @@ def handler(msg, addr):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--viewleader', default='localhost')
+    parser.add_argument('--workers', type=int, default=common2.WORKERS)
+    parser.add_argument('--backlog', type=int, default=common2.LISTEN_BACKLOG)
+    parser.add_argument('--max-message-size', type=int, default=common.MAX_MESSAGE_SIZE)
+    parser.add_argument('--data-dir', help="keep the store on disk here")
+    parser.add_argument('--capacity', type=int,
+        help="bytes of keys and values to hold at most, evicting the least recently used")
+    parser.add_argument('--publish-bloom', action='store_true', default=common2.BLOOM_PUBLISH,
+        help="send the store's Bloom filter to the viewleader, for clients' bloom reads")
     args = parser.parse_args()
     config["viewleader"] = args.viewleader
+    config["publish_bloom"] = args.publish_bloom
+    store.set_capacity(args.capacity)
+    if args.data_dir is not None:
+        recover(args.data_dir)
+        with state_lock:
+            log_records([("del", k) for k in store.evict()])
+        log_sync()
+    print ("Server Hash ID: {}".format(config["server_hash"]))
  
     for port in range(common2.SERVER_LOW, common2.SERVER_HIGH):
         print "Trying to listen on %s..." % port
-        result = common.listen(port, handler, 10)
+        result = common.listen(port, handler, 10, args.workers, args.backlog,
+            args.max_message_size)
         print result
     print "Can't listen on any port, giving up"
 
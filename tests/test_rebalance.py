@@ -0,0 +1,166 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import common
+import kvstore
+import server
+
+# Regression checks for the arc arithmetic rebalances rely on, and for
+# which servers a joining server asks for the keys it gains.
+# Run with: python -m unittest discover tests
+
+def random_arcs(rng, n):
+    arcs = []
+    for i in range(n):
+        lo = rng.randint(0, common.HASH_MAX - 1)
+        arcs.append([lo, min(common.HASH_MAX, lo + rng.randint(0, common.HASH_MAX // 8))])
+    return common.merge_arcs(arcs)
+
+def in_arcs(h, arcs):
+    return any(lo <= h < hi for (lo, hi) in arcs)
+
+class ArcTest(unittest.TestCase):
+    def test_merge(self):
+        self.assertEqual(common.merge_arcs([[5, 9], [0, 3], [3, 4], [8, 12], [20, 20]]),
+            [[0, 4], [5, 12]])
+
+    def test_intersect_and_subtract(self):
+        a = [[0, 10], [20, 30]]
+        b = [[5, 25]]
+        self.assertEqual(common.intersect_arcs(a, b), [[5, 10], [20, 25]])
+        self.assertEqual(common.subtract_arcs(a, b), [[0, 5], [25, 30]])
+        self.assertEqual(common.subtract_arcs(b, a), [[10, 20]])
+
+    # every point of a is in exactly one of intersect(a, b) and
+    # subtract(a, b), and no point outside a is in either
+    def test_random_arcs(self):
+        rng = random.Random(1)
+        for trial in range(200):
+            a = random_arcs(rng, rng.randint(0, 6))
+            b = random_arcs(rng, rng.randint(0, 6))
+            both = common.intersect_arcs(a, b)
+            rest = common.subtract_arcs(a, b)
+            edges = [x for arc in a + b for x in arc]
+            points = [rng.randint(0, common.HASH_MAX - 1) for i in range(50)]
+            for h in points + edges + [x - 1 for x in edges]:
+                if not 0 <= h < common.HASH_MAX:
+                    continue
+                self.assertEqual(in_arcs(h, both), in_arcs(h, a) and in_arcs(h, b))
+                self.assertEqual(in_arcs(h, rest), in_arcs(h, a) and not in_arcs(h, b))
+
+    def test_segments(self):
+        rng = random.Random(5)
+        ring = common.Ring([rng.randint(0, common.HASH_MAX - 1) for i in range(9)])
+        for trial in range(100):
+            lo = rng.randint(0, common.HASH_MAX - 1)
+            hi = rng.randint(lo, common.HASH_MAX)
+            pieces = ring.segments(lo, hi)
+            self.assertEqual(common.merge_arcs([arc for (arc, replicas) in pieces]),
+                common.merge_arcs([[lo, hi]]))
+            for (arc, replicas) in pieces:
+                for h in (arc[0], arc[1] - 1, rng.randint(arc[0], arc[1] - 1)):
+                    self.assertEqual(ring.replicas_for(h), replicas)
+
+    def test_ring_arcs(self):
+        rng = random.Random(2)
+        sids = [rng.randint(0, common.HASH_MAX - 1) for i in range(7)]
+        ring = common.Ring(sids)
+        arcs = dict((sid, ring.arcs(sid)) for sid in sids)
+        for i in range(2000):
+            h = rng.randint(0, common.HASH_MAX - 1)
+            for sid in sids:
+                self.assertEqual(in_arcs(h, arcs[sid]), ring.covers(sid, h))
+
+class ShareRequestsTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        self.old_view = [rng.randint(0, common.HASH_MAX - 1) for i in range(5)]
+        self.joined = [rng.randint(0, common.HASH_MAX - 1) for i in range(3)]
+        self.view = self.old_view + self.joined
+        self.points = [rng.randint(0, common.HASH_MAX - 1) for i in range(3000)]
+
+    # Checks that each server joining the view asks some server that
+    # stored the key before for every key it gains
+    def check_joins(self, old_ring):
+        before = common.Ring(self.old_view)
+        ring = common.Ring(self.view)
+        for sid in self.joined:
+            gained = ring.arcs(sid)
+            fetches = server.share_plan(sid, gained, self.view, ring, old_ring)
+            requests = server.share_requests(sid, fetches, old_ring is None)
+            for h in self.points:
+                if not ring.covers(sid, h):
+                    continue
+                asked = [peer for peer in requests if in_arcs(h, requests[peer]["arcs"])]
+                self.assertTrue(any(before.covers(peer, h) for peer in asked),
+                    "%s gains %s but asks none of its holders" % (sid, h))
+                if old_ring is not None:
+                    # from one server, with the other holders to fall back on
+                    self.assertEqual(len(asked), 1)
+                    candidates = [c for (arc, c) in fetches if in_arcs(h, [arc])][0]
+                    self.assertEqual(set(peer for peer in candidates if before.covers(peer, h)),
+                        set(before.replicas_for(h)))
+
+    # several servers joining in one rebalance, told the old view
+    def test_multi_join(self):
+        self.check_joins(common.Ring(self.old_view))
+
+    # ... or with no old view to go by
+    def test_multi_join_without_old_view(self):
+        self.check_joins(None)
+
+    # asking the new view's holders alone misses keys the other newcomers
+    # took over from their old holders
+    def test_new_ring_alone_misses_keys(self):
+        ring = common.Ring(self.view)
+        before = common.Ring(self.old_view)
+        missed = 0
+        for sid in self.joined:
+            for h in self.points:
+                if ring.covers(sid, h) and not any(before.covers(peer, h)
+                        for peer in ring.replicas_for(h) if peer != sid):
+                    missed += 1
+        self.assertTrue(missed > 0)
+
+class RevertTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (dict(server.config), server.store)
+        server.store = kvstore.Store()
+        rng = random.Random(4)
+        self.sid = rng.randint(0, common.HASH_MAX - 1)
+        others = [rng.randint(0, common.HASH_MAX - 1) for i in range(5)]
+        # a server leaves, so this one gains arcs
+        self.before = common.Ring([self.sid] + others)
+        self.after = common.Ring([self.sid] + others[1:])
+        server.config["view"] = [self.sid] + others
+        server.config["arcs"] = self.before.arcs(self.sid)
+        self.keys = ["k%s" % i for i in range(2000)]
+
+    def tearDown(self):
+        server.config.clear()
+        server.config.update(self.saved[0])
+        server.store = self.saved[1]
+
+    # keys fetched for a rebalance that is then reverted don't stay on
+    # arcs the server never took up
+    def test_revert_drops_fetched_keys(self):
+        held = [key for key in self.keys if self.before.covers(self.sid, common.hash_key(key))]
+        fetched = [key for key in self.keys if self.after.covers(self.sid, common.hash_key(key))
+            and key not in held]
+        self.assertTrue(fetched)
+        for key in held + fetched:
+            server.put_entry(key, {"val": "v", "version": 1})
+        new_arcs = self.after.arcs(self.sid)
+        server.config["next"] = (self.after.sids, new_arcs,
+            common.subtract_arcs(server.config["arcs"], new_arcs))
+        server.config["rebalancing"] = True
+        self.assertEqual(server.revert({"cmd": "revert"}, None)["status"], "reverted")
+        self.assertEqual(sorted(server.store.keys()), sorted(held))
+        self.assertFalse(server.config["rebalancing"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
 import time
+import heapq
+import collections
 import common
 import common2
 import threading
@@ -9,170 +11,464 @@ import threading
 # Globals
 
 # Stores global configuration variables
+# "epoch" starts from this viewleader's generation (see common.first_epoch)
+# "view" is the server IDs of the last finalized view, sent with every
+# rebalance so that servers new to the view know who held what before it
 config = {
-    "epoch": 0,
-
-    # List of expired leases
-    "expired": [],
+    "epoch": common.first_epoch(),
+    "view": None,
 }
 
-# Stores all server leases
-leases = []
+# Stores all server leases, by lockid ("host:port")
+leases = {}
+
+# When each lease runs out, as a min-heap of (deadline, lockid) with one
+# entry per lease. A heartbeat only moves its lease's timestamp; the stale
+# entry is pushed back with the new deadline when it reaches the top.
+lease_heap = []
+
+# Requestors whose leases expired, and when, oldest first. They are
+# denied a lease for common2.EXPIRED_RETENTION seconds, and only the
+# latest common2.EXPIRED_MAX are kept.
+expired = collections.OrderedDict()
 
-# Store all locks
-locks = []
+# Store all locks, by lockid
+locks = {}
+
+# Requests are handled concurrently, and rebalances run on their own
+# threads, so every access to config, leases and locks holds this lock.
+state_lock = threading.RLock()
 
 ###################
 # RPC implementations
 
-# Try to acquire a lock
+# Try to acquire a lock. With "wait", a requestor that would be told to
+# retry is instead parked for up to that many seconds, and answered as
+# soon as the lock passes to it. With "lease", the requestor must come
+# back (lock_get again, which renews) within that many seconds of its
+# last answer, or it is dropped from the lock, holder or not; without
+# one, it stays until it releases the lock.
 def lock_get(msg, addr):
-    lockid = msg["lockid"]
-    requestor = msg["requestor"]
-    for lock in locks:
-        if lock["lockid"] == lockid:
-            if len(lock["queue"]) == 0:
-                lock["queue"].append(requestor)
-                return {"status": "granted"}
-            elif lock["queue"][0] == requestor:
-                return {"status": "granted"}
-            else:
-                if requestor not in lock["queue"]:
-                    lock["queue"].append(requestor)
-                return {"status": "retry"}
-    else:
+    answers = []
+    with state_lock:
+        lockid = msg["lockid"]
+        requestor = msg["requestor"]
+        res = lock_get_locked(lockid, requestor)
+        lock = locks[lockid]
+        lock["leases"][requestor] = msg.get("lease")
+        if res["status"] == "retry" and msg.get("wait"):
+            res = park(lock, requestor, msg["wait"], answers)
+        else:
+            renew(lock, requestor)
+    deliver(answers)
+    return res
+
+def lock_get_locked(lockid, requestor):
+    lock = locks.get(lockid)
+    if lock is None:
         # this lock doesn't exist yet
-        locks.append({"lockid":lockid, "queue": [requestor]})
+        lock = locks[lockid] = {"lockid": lockid, "queue": [],
+            # parked requestors: (future, cancel)
+            "waiters": {},
+            # lease timers: (deadline, cancel)
+            "timers": {},
+            "leases": {}}
+    if len(lock["queue"]) == 0:
+        lock["queue"].append(requestor)
+        return {"status": "granted"}
+    elif lock["queue"][0] == requestor:
         return {"status": "granted"}
+    else:
+        if requestor not in lock["queue"]:
+            lock["queue"].append(requestor)
+        return {"status": "retry"}
 
 # Release a held lock, or remove oneself from waiting queue
 def lock_release(msg, addr):
-    lockid = msg["lockid"]
-    requestor = msg["requestor"]
-    for lock in locks:
-        if lock["lockid"] == lockid:
-            if requestor in lock["queue"]:
-                lock["queue"].remove(requestor)
-                return {"status": "ok"}
-    else:
+    answers = []
+    with state_lock:
+        res = lock_release_locked(msg["lockid"], msg["requestor"], answers)
+    deliver(answers)
+    return res
+
+# Responses for parked requests are gathered in answers and sent by
+# deliver() once state_lock is let go of.
+def lock_release_locked(lockid, requestor, answers):
+    lock = locks.get(lockid)
+    if lock is None or requestor not in lock["queue"]:
         return {"status": "unknown"}
+    holder = lock["queue"][0]
+    lock["queue"].remove(requestor)
+    stop_timer(lock, requestor)
+    lock["leases"].pop(requestor, None)
+    if requestor in lock["waiters"]:
+        (future, cancel) = lock["waiters"].pop(requestor)
+        cancel.set()
+        answers.append((future, {"status": "unknown"}))
+    if len(lock["queue"]) == 0:
+        del locks[lockid]
+    elif lock["queue"][0] != holder:
+        hand_over(lock, answers)
+    return {"status": "ok"}
+
+# The lock has a new holder; if it is parked, grant it the lock now
+# (caller holds the lock)
+def hand_over(lock, answers):
+    holder = lock["queue"][0]
+    if holder in lock["waiters"]:
+        (future, cancel) = lock["waiters"].pop(holder)
+        cancel.set()
+        renew(lock, holder)
+        answers.append((future, {"status": "granted"}))
+
+# Parks a request until the lock is handed over to requestor, or until
+# wait seconds have passed, when it is told to retry as usual
+# (caller holds the lock)
+def park(lock, requestor, wait, answers):
+    stop_timer(lock, requestor)
+    if requestor in lock["waiters"]:
+        # asked again while parked; the older request gives way
+        (future, cancel) = lock["waiters"].pop(requestor)
+        cancel.set()
+        answers.append((future, {"status": "retry"}))
+    future = common.Future()
+    cancel = common.after(wait, stop_waiting, lock["lockid"], requestor, future)
+    lock["waiters"][requestor] = (future, cancel)
+    return future
+
+def stop_waiting(lockid, requestor, future):
+    with state_lock:
+        lock = locks.get(lockid)
+        if lock is None or lock["waiters"].get(requestor, (None,))[0] is not future:
+            return
+        del lock["waiters"][requestor]
+        renew(lock, requestor)
+    future.set_result({"status": "retry"})
+
+# Restarts requestor's lease, if it has one
+# (caller holds the lock)
+def renew(lock, requestor):
+    stop_timer(lock, requestor)
+    lease = lock["leases"].get(requestor)
+    if lease:
+        deadline = time.time() + lease
+        cancel = common.after(lease, lease_expired, lock["lockid"], requestor)
+        lock["timers"][requestor] = (deadline, cancel)
+
+def stop_timer(lock, requestor):
+    if requestor in lock["timers"]:
+        lock["timers"].pop(requestor)[1].set()
 
-# Manage requests for a server lease
+# The requestor hasn't been heard from within its lease, so it is taken
+# to have gone away, and the lock passes on
+def lease_expired(lockid, requestor):
+    answers = []
+    with state_lock:
+        lock = locks.get(lockid)
+        timer = lock["timers"].get(requestor) if lock is not None else None
+        if timer is None or timer[0] > time.time():
+            # renewed or released since
+            return
+        print "Lock %s: lease of %s expired" % (lockid, requestor)
+        lock_release_locked(lockid, requestor, answers)
+    deliver(answers)
+
+def deliver(answers):
+    for (future, res) in answers:
+        future.set_result(res)
+
+# Manage requests for a server lease. A heartbeat may carry a snapshot
+# of the Bloom filter of the server's keys, which is kept with its lease
+# for query_servers; the reply says which version of it is kept.
 def server_lease(msg, addr):
+    with state_lock:
+        res = server_lease_locked(msg, addr)
+        if res.get("status") == "ok":
+            lease = leases["%s:%s" % (addr, msg["port"])]
+            if "bloom" in msg:
+                lease["bloom"] = msg["bloom"]
+            res["bloom"] = lease.get("bloom", {}).get("version")
+        return res
+
+def server_lease_locked(msg, addr):
     lockid = "%s:%s" % (addr, msg["port"])
     requestor = msg["requestor"]
 
     remove_expired_leases()
 
-    if msg["requestor"] in config["expired"]:
+    if requestor in expired:
         return {"status": "deny"}
 
-    for lease in leases:
-        if lease["lockid"] == lockid:
-            # lease is present
-
-            if time.time() - lease["timestamp"] > common2.LOCK_LEASE:
-                # lease expired
-                if lease["requestor"] == requestor:
-                    # server lost lease, then recovered, but we deny it
-                    return {"status": "deny"}
-                else:
-                    # another server at same address is okay
-                    lease["timestamp"] = time.time()
-                    lease["requestor"] = requestor
-                    config["epoch"] += 1
-                    print "Rebalance: transfer address lease"
-                    rebalThread = threading.Thread(target=rebalance)
-                    rebalThread.start()
-                    return {"status": "ok", "epoch": config["epoch"]}
-            else:
-                # lease still active
-                if lease["requestor"] == requestor:
-                    # refreshing ownership
-                    lease["timestamp"] = time.time()
-                    return {"status": "ok", "epoch": config["epoch"]}
-                else:
-                    # locked by someone else
-                    return {"status": "retry", "epoch": config["epoch"]}
-    else:
+    lease = leases.get(lockid)
+    if lease is None:
         # lock not present yet
-        leases.append({"lockid": lockid, "requestor": requestor, "timestamp": time.time()})
+        add_lease(lockid, requestor)
         config["epoch"] += 1
-        print "Rebalance: new server"
-        rebalThread = threading.Thread(target=rebalance)
-        rebalThread.start()
-        return {"status": "ok", "epoch": config["epoch"]}
+        record_change([leases[lockid]], [])
+        schedule_rebalance("new server")
+        return {"status": "ok", "epoch": config["epoch"], "lease": common2.LOCK_LEASE}
 
-# Check which leases have already expired
-def remove_expired_leases():
-    global leases
-    expired = False
-    new_leases = []
-    for lease in leases:
-        if time.time() - lease['timestamp'] <= common2.LOCK_LEASE:
-            new_leases.append(lease)
+    if time.time() - lease["timestamp"] > common2.LOCK_LEASE:
+        # lease expired
+        if lease["requestor"] == requestor:
+            # server lost lease, then recovered, but we deny it
+            return {"status": "deny"}
+        else:
+            # another server at same address is okay
+            left = lease["requestor"]
+            lease["timestamp"] = time.time()
+            lease["requestor"] = requestor
+            config["epoch"] += 1
+            record_change([lease], [left])
+            schedule_rebalance("transfer address lease")
+            return {"status": "ok", "epoch": config["epoch"], "lease": common2.LOCK_LEASE}
+    else:
+        # lease still active
+        if lease["requestor"] == requestor:
+            # refreshing ownership
+            lease["timestamp"] = time.time()
+            return {"status": "ok", "epoch": config["epoch"], "lease": common2.LOCK_LEASE}
         else:
-            config["expired"].append(lease["requestor"])
-            expired = True
-    leases=new_leases
-    if expired:
+            # locked by someone else
+            return {"status": "retry", "epoch": config["epoch"]}
+
+# (caller holds the lock)
+def add_lease(lockid, requestor):
+    now = time.time()
+    leases[lockid] = {"lockid": lockid, "requestor": requestor, "timestamp": now}
+    heapq.heappush(lease_heap, (now + common2.LOCK_LEASE, lockid))
+
+# Check which leases have already expired. Only the leases at the top of
+# the heap are looked at, so this costs O(log n) per lease that expired or
+# was renewed since the last call, not O(n).
+# (caller holds the lock)
+def remove_expired_leases():
+    now = time.time()
+    removed = []
+    while lease_heap and lease_heap[0][0] < now:
+        (deadline, lockid) = heapq.heappop(lease_heap)
+        lease = leases[lockid]
+        if now - lease["timestamp"] <= common2.LOCK_LEASE:
+            # renewed since the entry was pushed
+            heapq.heappush(lease_heap, (lease["timestamp"] + common2.LOCK_LEASE, lockid))
+            continue
+        del leases[lockid]
+        expired.pop(lease["requestor"], None)
+        expired[lease["requestor"]] = now
+        removed.append(lease["requestor"])
+    forget_expired(now)
+    if removed:
         config["epoch"] += 1
+        record_change([], removed)
         if len(leases)>1:
-            print "Rebalance: view reduced"
-            rebalThread = threading.Thread(target=rebalance)
-            rebalThread.start() 
+            schedule_rebalance("view reduced")
+
+# Drops the expired requestors that are past their retention
+# (caller holds the lock)
+def forget_expired(now):
+    while expired:
+        (requestor, when) = next(expired.iteritems())
+        if len(expired) <= common2.EXPIRED_MAX and now - when <= common2.EXPIRED_RETENTION:
+            break
+        del expired[requestor]
 
+##############
+# Rebalance scheduling
+# A lease change only asks for a rebalance. One scheduler thread runs
+# them, one at a time, once the view has settled: when it hasn't changed
+# for common2.REBALANCE_SETTLE seconds, or REBALANCE_MAX_DELAY seconds
+# after the first change it hasn't served yet, whichever comes first.
+# Servers joining or expiring close together then cost one rebalance, to
+# the latest epoch, rather than one each. A rebalance overtaken by a
+# newer request before it finalizes is reverted, and the newer one runs
+# in its place.
+scheduled = {
+    # when the first and the latest unserved requests came, and why
+    "first": None,
+    "last": None,
+    "reasons": [],
+}
+scheduler_wakeup = threading.Condition(state_lock)
+
+# Counters for rebalance_stats: rebalances asked for, run, finalized,
+# reverted, and reverted because they were overtaken; and the keys
+# servers fetched from each other and dropped
+stats = {"requested": 0, "run": 0, "finalized": 0, "reverted": 0,
+    "superseded": 0, "keys_moved": 0, "keys_dropped": 0}
 
+# Asks for a rebalance to the current epoch
+# (caller holds the lock)
+def schedule_rebalance(reason):
+    now = time.time()
+    if scheduled["first"] is None:
+        scheduled["first"] = now
+    scheduled["last"] = now
+    scheduled["reasons"].append(reason)
+    stats["requested"] += 1
+    scheduler_wakeup.notify()
+
+def rebalance_scheduler():
+    while True:
+        with state_lock:
+            while scheduled["first"] is None:
+                scheduler_wakeup.wait()
+            while True:
+                due = min(scheduled["last"] + common2.REBALANCE_SETTLE,
+                    scheduled["first"] + common2.REBALANCE_MAX_DELAY)
+                if time.time() >= due:
+                    break
+                scheduler_wakeup.wait(due - time.time())
+            print "Rebalance: %s" % ", ".join(scheduled["reasons"])
+            scheduled["first"] = None
+            scheduled["reasons"] = []
+            stats["run"] += 1
+        try:
+            rebalance()
+        except Exception as e:
+            print "Rebalance failed: %s" % e
+
+# Rebalance counters, and how many rebalances the scheduler saved
+def rebalance_stats(msg, addr):
+    with state_lock:
+        res = dict(stats)
+    res["avoided"] = res["requested"] - res["run"]
+    return res
 
-# THREAD
 # rebalance manages a sort of distributed commit on store updates,
 # so that no items are lost due to the order of a server's updating 
 # and sharing of keys. It deploys finalize or revert, depending one
 # the status return messages of each server to the rebalance broadcast.
+# Only the scheduler thread runs it.
 def rebalance():
     server_ids=[]
     serverdata={}
-    for server in leases:
-        (h,p)=common.formatHP(server["lockid"])
-        val={"host":h, "port":p}
-        n=int(server["requestor"])
-        server_ids.append(n)
-        serverdata[n]=val
-    msg={"cmd":"rebalance", "epoch": config["epoch"],
-        "group_size":len(leases), "view": server_ids, 
-        "serverdata": serverdata}
+    with state_lock:
+        for server in leases.values():
+            (h,p)=common.formatHP(server["lockid"])
+            val={"host":h, "port":p}
+            n=int(server["requestor"])
+            server_ids.append(n)
+            serverdata[n]=val
+        epoch=config["epoch"]
+        msg={"cmd":"rebalance", "epoch": epoch,
+            "group_size":len(leases), "view": server_ids, 
+            "old_view": config["view"], "serverdata": serverdata}
     responses=common.broadcast_receive(server_ids,serverdata,msg)
     #print responses #Testing
+    with state_lock:
+        stats["keys_moved"]+=sum(r.get("keys", 0) for r in responses)
+        superseded=scheduled["first"] is not None
     for r in responses:
         if "error" in r:
-            revert(server_ids, serverdata)
+            revert(server_ids, serverdata, epoch)
             break
     else: 
-        finalize(server_ids, serverdata)
+        if superseded:
+            print "Rebalance to epoch %s superseded" % epoch
+            with state_lock:
+                stats["superseded"]+=1
+            revert(server_ids, serverdata, epoch)
+        else:
+            finalize(server_ids, serverdata, epoch)
 # broadcast server RPC, has the effect of finishing the rebalance process
-def finalize(sids, data):
-    msg={"cmd": "finalize", "epoch": config["epoch"]}
+def finalize(sids, data, epoch):
+    msg={"cmd": "finalize", "epoch": epoch}
     responses=common.broadcast_receive(sids,data,msg)
+    with state_lock:
+        config["view"]=sids
+        stats["finalized"]+=1
+        stats["keys_dropped"]+=sum(r.get("dropped", 0) for r in responses)
     print responses
 # broadcast to cancel a rebalance process    
-def revert(sids, data):
-    msg={"cmd": "revert", "epoch": config["epoch"]}
+def revert(sids, data, epoch):
+    msg={"cmd": "revert", "epoch": epoch}
     responses=common.broadcast_receive(sids,data,msg)
+    with state_lock:
+        stats["reverted"]+=1
     print"Revert result:", responses #??? TESTING
 
 
 
-# Output the set of currently active servers
+# Output the set of currently active servers, with "bloom" their key
+# filters as well
 def query_servers(msg, addr):
-    servers = []
-    remove_expired_leases()
-    for lease in leases:
-        ip = lease["lockid"]
-        name = lease["requestor"]
-        servers.append({"name" : name, "location" : ip})
+    with state_lock:
+        remove_expired_leases()
+        return current_view(msg.get("bloom"))
 
+# (caller holds the lock)
+def current_view(bloom=False):
+    servers = []
+    for lease in leases.values():
+        server = server_entry(lease)
+        if bloom and "bloom" in lease:
+            server["bloom"] = lease["bloom"]
+        servers.append(server)
     return {"result": servers, "epoch": config["epoch"]}
 
+def server_entry(lease):
+    return {"name": lease["requestor"], "location": lease["lockid"]}
+
+##############
+# View subscriptions
+# Rather than poll query_servers, servers and clients may subscribe to
+# the view. A subscription is answered with the whole view, as
+# query_servers gives it (without filters), and stays open: every change
+# to the view after that is sent down it as a delta, {"epoch", "joined",
+# "left"}, with the servers that joined and the names of those that left.
+# One publisher thread sends the changes, in epoch order, so that no
+# request waits on a slow subscriber. When nothing changes it sends just
+# the epoch every common2.VIEW_KEEPALIVE seconds, to show the
+# subscription is alive. A subscriber whose connection fails is dropped.
+
+# The subscriptions, each {"feed": common.Feed, "epoch": the epoch it
+# has been sent up to}
+subscribers = []
+
+# Changes to the view not yet sent to the subscribers, oldest first
+view_changes = []
+publisher_wakeup = threading.Condition(state_lock)
+
+# Records a change to the view, made with the current epoch, for the
+# subscribers
+# (caller holds the lock)
+def record_change(joined, left):
+    view_changes.append({"epoch": config["epoch"],
+        "joined": [server_entry(lease) for lease in joined], "left": left})
+    publisher_wakeup.notify()
+
+def subscribe(msg, addr):
+    with state_lock:
+        remove_expired_leases()
+        view = current_view()
+        subscribers.append({"feed": common.Feed(view), "epoch": view["epoch"]})
+        return subscribers[-1]["feed"]
+
+def view_publisher():
+    while True:
+        with state_lock:
+            if not view_changes:
+                publisher_wakeup.wait(common2.VIEW_KEEPALIVE)
+            # servers that went quiet leave the view now, not at the next
+            # request that looks
+            remove_expired_leases()
+            changes = view_changes[:]
+            del view_changes[:]
+            targets = list(subscribers)
+            epoch = config["epoch"]
+        dropped = []
+        for subscriber in targets:
+            parts = [change for change in changes if change["epoch"] > subscriber["epoch"]]
+            for part in parts or [{"epoch": epoch}]:
+                if not subscriber["feed"].push(part):
+                    dropped.append(subscriber)
+                    break
+            subscriber["epoch"] = max([subscriber["epoch"]] + [part["epoch"] for part in parts])
+        if dropped:
+            with state_lock:
+                for subscriber in dropped:
+                    subscribers.remove(subscriber)
+
 def init(msg, addr):
     return {}
 
@@ -187,16 +483,25 @@ def handler(msg, addr):
         "query_servers": query_servers,
         "lock_get": lock_get,
         "lock_release": lock_release,
+        "rebalance_stats": rebalance_stats,
+        "subscribe": subscribe,
     }
 
     return cmds[msg["cmd"]](msg, addr)
 
 # Server entry point
 def main():
- 
+    scheduler = threading.Thread(target=rebalance_scheduler)
+    scheduler.daemon = True
+    scheduler.start()
+    publisher = threading.Thread(target=view_publisher)
+    publisher.daemon = True
+    publisher.start()
+
     for port in range(common2.VIEWLEADER_LOW, common2.VIEWLEADER_HIGH):
         print "Trying to listen on %s..." % port
-        result = common.listen(port, handler)
+        result = common.listen(port, handler, None, common2.WORKERS,
+            common2.LISTEN_BACKLOG)
         print result
     print "Can't listen on any port, giving up"
 
@@ -0,0 +1,192 @@
+import os
+import zlib
+import mmap
+import struct
+import marshal
+import threading
+
+# On-disk state of a server's store, kept in its data directory:
+#
+#   wal.00000001, wal.00000002, ...   segments of the write-ahead log
+#   snapshot                          the whole store, as of the start of
+#                                     the segment named in its header
+#
+# Every update to the store is appended to the current log segment as a
+# record, ("set", key, entry) or ("del", key), before the RPC that made
+# it is answered. Taking a snapshot starts a new segment; the snapshot
+# holds everything in the segments before it, which are then deleted.
+# Recovery loads the snapshot and replays the segments from there on.
+
+# A record is its length and CRC-32 followed by its marshal encoding. A
+# record that is cut short or doesn't match its CRC is the tail of a
+# write that a crash interrupted, and ends the segment.
+RECORD = struct.Struct("!Ii")
+MARSHAL_VERSION = 2
+
+def encode_record(record):
+    payload = marshal.dumps(record, MARSHAL_VERSION)
+    return RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+# The records in a log segment, in the order they were written
+def read_records(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        (length, crc) = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        end = start + length
+        if end > len(data) or zlib.crc32(data[start:end]) != crc:
+            return
+        yield marshal.loads(data[start:end])
+        offset = end
+
+def segment_path(data_dir, segment):
+    return os.path.join(data_dir, "wal.%08d" % segment)
+
+# The numbers of the log segments in data_dir, in order
+def segments(data_dir):
+    found = []
+    for name in os.listdir(data_dir):
+        if name.startswith("wal.") and name[4:].isdigit():
+            found.append(int(name[4:]))
+    return sorted(found)
+
+# Replaces the file at path with data, so that a crash leaves either the
+# old contents or the new ones
+def write_file(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    sync_dir(os.path.dirname(path) or ".")
+
+def sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+##############
+# Log
+# An open segment of the log, with group commit: appending a record only
+# buffers it, and sync() makes everything appended so far durable. When
+# several threads sync at once, the first one to arrive fsyncs on behalf
+# of all of them and the rest wait for it, so one fsync covers every
+# write that was appended before it started.
+class Log(object):
+    def __init__(self, data_dir, segment):
+        self.data_dir = data_dir
+        self.segment = segment
+        self.file = open(segment_path(data_dir, segment), "ab")
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.syncing = False
+        # appends made, and how many of them are known to be on disk
+        self.written = 0
+        self.durable = 0
+        # records in the current segment
+        self.records = 0
+
+    def append(self, records):
+        data = "".join(encode_record(record) for record in records)
+        with self.lock:
+            self.file.write(data)
+            self.written += 1
+            self.records += len(records)
+
+    # Returns once every record appended before the call is on disk
+    def sync(self):
+        with self.lock:
+            target = self.written
+            while self.durable < target:
+                if self.syncing:
+                    self.synced.wait()
+                else:
+                    self.flush()
+
+    # Writes out and fsyncs the segment; the lock is let go of during the
+    # fsync, so that appends can carry on. Caller holds self.lock.
+    def flush(self):
+        self.syncing = True
+        target = self.written
+        try:
+            self.file.flush()
+            fd = self.file.fileno()
+            self.lock.release()
+            try:
+                os.fsync(fd)
+            finally:
+                self.lock.acquire()
+            self.durable = max(self.durable, target)
+        finally:
+            self.syncing = False
+            self.synced.notify_all()
+
+    # Closes the current segment, once it is on disk, and starts the next.
+    # Returns the number of the new segment. Unlike flush(), this holds the
+    # lock throughout, so nothing can be appended to the old segment after
+    # its fsync.
+    def rotate(self):
+        with self.lock:
+            while self.syncing:
+                self.synced.wait()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.durable = self.written
+            self.synced.notify_all()
+            self.file.close()
+            self.segment += 1
+            self.file = open(segment_path(self.data_dir, self.segment), "ab")
+            self.records = 0
+            return self.segment
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+##############
+# Snapshots
+# A snapshot is a header followed by the store's entries in ring order, as
+# parallel lists of positions, keys and entries (kvstore.Store.dump()).
+# Version 2 holds the entries as (val, version) tuples, version 1 as
+# dicts; both can be loaded.
+# With the positions and their order saved, loading one needs no hashing
+# and no sorting; the file is mapped into memory and decoded in one pass.
+SNAPSHOT_MAGIC = "DHTS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_VERSIONS = (1, 2)
+# magic | version | the first log segment not included
+SNAPSHOT_HEADER = struct.Struct("!4sII")
+
+def snapshot_path(data_dir):
+    return os.path.join(data_dir, "snapshot")
+
+# Saves a snapshot of everything logged before segment, and deletes the
+# segments it replaces
+def write_snapshot(data_dir, segment, dump):
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, segment)
+    write_file(snapshot_path(data_dir), header + marshal.dumps(dump, MARSHAL_VERSION))
+    for old in segments(data_dir):
+        if old < segment:
+            os.remove(segment_path(data_dir, old))
+
+# Returns the first segment the latest snapshot doesn't include, and its
+# dump; (0, None) if there is no snapshot
+def read_snapshot(data_dir):
+    path = snapshot_path(data_dir)
+    if not os.path.exists(path):
+        return (0, None)
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, segment) = SNAPSHOT_HEADER.unpack_from(mapped)
+            if magic != SNAPSHOT_MAGIC or version not in SNAPSHOT_VERSIONS:
+                raise ValueError("%s is not a version %s snapshot" % (path, SNAPSHOT_VERSION))
+            dump = marshal.loads(mapped[SNAPSHOT_HEADER.size:])
+        finally:
+            mapped.close()
+    return (segment, dump)